@@ -0,0 +1,219 @@
+# Replays a response log written with recording enabled and reports the
+# tokens each filter_criteria variant would have alerted on:
+#   python backtest.py responses.jsonl.gz sweep.yaml --workers 4
+# sweep.yaml lists the variants as overrides of config.yaml's criteria:
+#   variants:
+#     - name: looser liquidity
+#       min_liquidity: 20000
+#     - name: no security check
+#       token_security: false
+# Responses the live run never fetched (e.g. the candles of a token the live
+# criteria rejected early) count as unavailable data, so record with loose
+# criteria to backtest stricter ones.
+import argparse
+import asyncio
+import json
+import math
+import os
+import yaml
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from birdeye_api import BirdeyeAPI
+from rate_limiter import PRIORITY_NORMAL
+from recording import read_log
+from resilience import CircuitOpenError
+from token_scanner import TokenScanner
+
+# Request parameters that change with the time of the call, not its subject
+TIME_PARAMS = {'from', 'to', 'time_from', 'time_to'}
+# Endpoints whose responses start a scan of the chain
+SCAN_ENDPOINTS = {'new_listings', 'all_tokens'}
+# Oldest response, in seconds before the replay clock, served to a request
+# the live scan did not make: the longest cache TTL in config.yaml
+MAX_RESPONSE_AGE = 3600
+
+
+def _request_key(path, params):
+    return path, tuple(
+        sorted((name, str(value)) for name, value in (params or {}).items()
+               if name not in TIME_PARAMS))
+
+
+class ReplayAPI(BirdeyeAPI):
+
+    # Serves recorded responses instead of calling Birdeye. Requests are
+    # matched on path and parameters, leaving out time ranges, and answered
+    # with the first response recorded at or after the replay clock (the one
+    # the live scan that started then received), or else the latest one
+    # recorded up to max_age seconds before it, which the live run would
+    # have had cached. The log is streamed: only the responses from max_age
+    # before the clock up to the next scan of the chain being replayed are
+    # held in memory.
+
+    def __init__(self, log_path, max_age=MAX_RESPONSE_AGE):
+        super().__init__(None, cache_settings={'ttl': {}})
+        self.max_age = max_age
+        # (recorded at, chain) of every scan, in order
+        self.scans = [(recorded_at, path.split('/')[3])
+                      for recorded_at, path, params, _ in read_log(log_path)
+                      if _starts_scan(path, params)]
+        self.entries = read_log(log_path)
+        self.next_entry = next(self.entries, None)
+        # Request key -> deque of (recorded at, data), keys recorded least
+        # recently first
+        self.responses = OrderedDict()
+        self.clock = self.scans[0][0] if self.scans else 0.0
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def replay_scans(self):
+        # Yields (recorded at, chain) per scan, with the clock set to its
+        # start and the responses it can be served loaded
+        ends = []
+        next_scans = {}  # chain -> start of its next scan
+        for recorded_at, chain in reversed(self.scans):
+            ends.append(next_scans.get(chain, math.inf))
+            next_scans[chain] = recorded_at
+        ends.reverse()
+        for (recorded_at, chain), end in zip(self.scans, ends):
+            self.clock = recorded_at
+            self._load(end)
+            yield recorded_at, chain
+
+    def _load(self, until):
+        entry = self.next_entry
+        while entry is not None and entry[0] < until:
+            recorded_at, path, params, data = entry
+            key = _request_key(path, params)
+            recorded = self.responses.get(key)
+            if recorded is None:
+                recorded = self.responses[key] = deque()
+            else:
+                self.responses.move_to_end(key)
+            recorded.append((recorded_at, data))
+            entry = self.next_entry = next(self.entries, None)
+        # Requests not recorded for max_age can no longer be answered
+        oldest = self.clock - self.max_age
+        while self.responses:
+            key, recorded = next(iter(self.responses.items()))
+            if recorded[-1][0] >= oldest:
+                break
+            del self.responses[key]
+
+    async def _get(self, path, params=None, priority=PRIORITY_NORMAL):
+        recorded = self.responses.get(_request_key(path, params))
+        if recorded:
+            # Responses before the latest one at or before the clock are
+            # never served again
+            while len(recorded) > 1 and recorded[1][0] <= self.clock:
+                recorded.popleft()
+            recorded_at, data = recorded[0]
+            if recorded_at < self.clock and len(recorded) > 1:
+                recorded_at, data = recorded[1]
+            if recorded_at >= self.clock - self.max_age:
+                return data
+        # Never fetched live: the scanner handles it like an outage
+        raise CircuitOpenError(path.split('/')[2], 0)
+
+
+def _starts_scan(path, params):
+    return (path.split('/')[2] in SCAN_ENDPOINTS
+            and not int(params.get('offset', 0)))
+
+
+def replay(log_path, variants, scan_new_listings_only, settings=None):
+    # Returns, per variant, {"chain/address": time of the first match}
+    return asyncio.run(
+        _replay(log_path, variants, scan_new_listings_only, settings or {}))
+
+
+async def _replay(log_path, variants, scan_new_listings_only, settings):
+    api = ReplayAPI(log_path)
+    scanner = TokenScanner(api,
+                           variants[0],
+                           scan_new_listings_only,
+                           settings.get('max_concurrent_requests', 20),
+                           settings.get('ohlcv_base_interval', '1m'),
+                           settings.get('candle_store_max_tokens', 5000),
+                           None,
+                           settings.get('seen_tokens', {}),
+                           settings.get('all_tokens_page_size', 500),
+                           candle_store_max_bytes=settings.get(
+                               'candle_store_max_bytes', 64 * 1024 * 1024))
+    scanner.clock = lambda: api.clock
+    if scanner.seen_tokens is not None:
+        # Seen-token TTLs run on the recorded time too, so a replay faster
+        # than the recording does not skip tokens the live run enriched
+        scanner.seen_tokens.clock = scanner.clock
+    # Every variant is a profile, so one pass evaluates all of them
+    for key, criteria in enumerate(variants):
+        scanner.profiles.publish(key, criteria)
+    scanner.profiles.set_subscribers(range(len(variants)))
+    matches = [{} for _ in variants]
+    for recorded_at, chain in api.replay_scans():
+        async for _, address, _, keys in scanner.stream_tokens([chain]):
+            for key in keys:
+                matches[key].setdefault(f"{chain}/{address}", recorded_at)
+    return matches
+
+
+def _replay_chunk(args):
+    return replay(*args)
+
+
+def sweep(log_path,
+          variants,
+          scan_new_listings_only,
+          settings=None,
+          workers=None):
+    # Variants are split across a process pool; each worker replays the log
+    # once for its share of them
+    workers = max(1, min(workers or os.cpu_count() or 1, len(variants)))
+    chunks = [variants[i::workers] for i in range(workers)]
+    with ProcessPoolExecutor(workers) as pool:
+        results = list(
+            pool.map(_replay_chunk,
+                     [(log_path, chunk, scan_new_listings_only, settings)
+                      for chunk in chunks]))
+    matches = [None] * len(variants)
+    for worker, chunk_matches in enumerate(results):
+        matches[worker::workers] = chunk_matches
+    return matches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('log')
+    parser.add_argument('sweep')
+    parser.add_argument('--config', default='config.yaml')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', help='write every match as JSON')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as file:
+        config = yaml.safe_load(file)
+    with open(args.sweep, 'r') as file:
+        overrides = yaml.safe_load(file)['variants']
+    names = []
+    variants = []
+    for number, override in enumerate(overrides, 1):
+        override = dict(override)
+        names.append(str(override.pop('name', f"variant {number}")))
+        variants.append({**config['filter_criteria'], **override})
+
+    matches = sweep(args.log, variants, config['scan_new_listings_only'],
+                    config, args.workers)
+    width = max(len(name) for name in names)
+    for name, variant_matches in zip(names, matches):
+        print(f"{name.ljust(width)}  {len(variant_matches)} matches")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(dict(zip(names, matches)), file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# Compares TokenFilter.matches_criteria with matches_batch on synthetic
+# tokens, with and without building the batch. Needs numpy. Run from the
+# repository root:
+#   python -m benchmarks.filter_batch --tokens 10000
+import argparse
+import random
+import time
+import yaml
+from records import SecurityReport, TokenRecord
+from token_filter import CHECKS, TokenFilter, to_batch
+
+
+def synthetic_payloads(count, periods, seed):
+    # Token and security payloads as Birdeye returns them, and window dicts
+    rng = random.Random(seed)
+    tokens, ohlcv_data, security_data = [], [], []
+    for i in range(count):
+        tokens.append({
+            'address':
+            f'token{i}',
+            'liquidity':
+            rng.uniform(0, 200000),
+            'marketCap':
+            rng.uniform(0, 20000000),
+            'totalSupply':
+            rng.choice([0, rng.uniform(1e3, 1e9)]),
+            'mintDate':
+            f'20{rng.randint(20, 25)}-0{rng.randint(1, 9)}-01T00:00:00Z'
+        })
+        ohlcv_data.append({
+            period: {
+                'volume': rng.uniform(0, 1e9),
+                'volume_usd': rng.uniform(0, 500000),
+                'price_change_percent': rng.uniform(-50, 100),
+                'valid_volume': rng.uniform(0, 500000)
+            }
+            for period in periods
+        })
+        security_data.append({
+            'creator_ownership': rng.uniform(0, 10),
+            'is_secure': rng.random() < 0.8
+        })
+    return tokens, ohlcv_data, security_data
+
+
+def synthetic_tokens(count, periods, seed):
+    tokens, ohlcv_data, security_data = synthetic_payloads(
+        count, periods, seed)
+    return ([TokenRecord.from_dict(token) for token in tokens], ohlcv_data,
+            [SecurityReport.from_dict(report) for report in security_data])
+
+
+def first_failed(plan, token, ohlcv_data, security_data):
+    data = {'token': token, 'ohlcv': ohlcv_data, 'security': security_data}
+    for index, (name, inputs) in enumerate(CHECKS):
+        check = getattr(plan, f'_check_{name}')
+        if not check(*(data[key] for key in inputs)):
+            return index
+    return -1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tokens', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--config', default='config.yaml')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as file:
+        criteria = yaml.safe_load(file)['filter_criteria']
+    token_filter = TokenFilter(criteria)
+    tokens, ohlcv_data, security_data = synthetic_tokens(
+        args.tokens, token_filter.required_intervals(), args.seed)
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        expected = [
+            token_filter.matches_criteria(*row)
+            for row in zip(tokens, ohlcv_data, security_data)
+        ]
+    scalar_time = (time.perf_counter() - start) / args.repeat
+
+    # The first call imports numpy; keep that out of the timings
+    to_batch(tokens[:1], ohlcv_data[:1], security_data[:1])
+    start = time.perf_counter()
+    batch = to_batch(tokens, ohlcv_data, security_data)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        mask, failed = token_filter.matches_batch(batch)
+    batch_time = (time.perf_counter() - start) / args.repeat
+
+    expected_failed = [
+        first_failed(token_filter.plan, *row)
+        for row in zip(tokens, ohlcv_data, security_data)
+    ]
+    assert mask.tolist() == expected, "batch mask differs from scalar path"
+    assert failed.tolist() == expected_failed, \
+        "first failing check differs from scalar path"
+
+    print(f"tokens:        {args.tokens} ({sum(expected)} matching)")
+    print(f"scalar:        {scalar_time * 1000:.2f} ms")
+    print(f"batch:         {batch_time * 1000:.2f} ms "
+          f"({scalar_time / batch_time:.1f}x)")
+    print(f"batch build:   {build_time * 1000:.2f} ms")
+    total_time = build_time + batch_time
+    print(f"build + batch: {total_time * 1000:.2f} ms "
+          f"({scalar_time / total_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
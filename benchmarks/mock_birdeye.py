@@ -0,0 +1,323 @@
+# Local stand-in for the Birdeye endpoints the client uses, for benchmarks.
+# Serves a synthetic token universe with configurable latency, 500/429
+# injection and a steady stream of new listings (polled or over WebSocket).
+# Run from the repository root:
+#   python -m benchmarks.mock_birdeye --tokens 100000 --port 8765
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from datetime import datetime
+from aiohttp import web
+
+CANDLE_STEP = 60
+# Per-candle price growth of tokens meant to match; flat for the rest
+GOOD_GROWTH = 1.012
+MAX_CACHED_CANDLES = 64
+
+
+class MockBirdeye:
+
+    # Token i of a chain is listed at started + i / listing_rate, so polling
+    # and push clients see the same listing times. Tokens are generated from
+    # their index on every request, so the universe costs no memory; about
+    # match_rate of them pass the default filter criteria.
+
+    def __init__(self,
+                 tokens=10000,
+                 listing_rate=5.0,
+                 latency='lognormal',
+                 latency_ms=50.0,
+                 latency_sigma=0.5,
+                 error_rate=0.0,
+                 throttle_rate=0.0,
+                 retry_after=1.0,
+                 match_rate=0.2,
+                 seed=1):
+        self.tokens = tokens
+        self.listing_rate = listing_rate
+        self.latency = latency
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.match_rate = match_rate
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.started = time.time()
+        self.candles = {}  # (good, time_from, time_to) -> response body
+        self.requests = {}  # endpoint -> count
+        self.runner = None
+
+    def app(self):
+        app = web.Application(middlewares=[self._inject])
+        app.router.add_get('/public/new_listings/{chain}', self._new_listings)
+        app.router.add_get('/public/all_tokens/{chain}', self._all_tokens)
+        app.router.add_get('/public/token/{chain}/{address}', self._token)
+        app.router.add_get('/public/token_security/{chain}/{address}',
+                           self._security)
+        app.router.add_get('/public/ohlcv/{chain}/{address}', self._ohlcv)
+        app.router.add_get('/socket/{chain}', self._socket)
+        return app
+
+    async def start(self, host='127.0.0.1', port=8765):
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        self.started = time.time()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def listed_at(self, index):
+        return self.started + index / self.listing_rate
+
+    def token(self, chain, index):
+        rng = self._token_rng(chain, index)
+        good = rng.random() < self.match_rate
+        if good:
+            liquidity = rng.uniform(1e5, 1e6)
+            market_cap = rng.uniform(2e5, 5e6)
+            total_supply = 1e8
+            mint_date = '2025-06-01T00:00:00Z'
+        else:
+            liquidity = rng.uniform(0, 2e5)
+            market_cap = rng.uniform(0, 2e7)
+            total_supply = rng.uniform(1e3, 1e10)
+            mint_date = f'20{rng.randint(21, 25)}-0{rng.randint(1, 9)}-01'
+        return {
+            'address': f'{chain}-{index}',
+            'symbol': f'T{index}',
+            'price': rng.uniform(1e-4, 10),
+            'liquidity': liquidity,
+            'marketCap': market_cap,
+            'totalSupply': total_supply,
+            'mintDate': mint_date,
+            'volume': {
+                'h24': rng.uniform(0, 1e6)
+            },
+            'priceChange': {
+                'h24': rng.uniform(-50, 100)
+            }
+        }, good
+
+    def _token_rng(self, chain, index):
+        return random.Random(self.seed * 1000003 + index * 31 +
+                             sum(map(ord, chain)))
+
+    def _index(self, request):
+        try:
+            return int(request.match_info['address'].rsplit('-', 1)[1])
+        except (IndexError, ValueError):
+            return None
+
+    def _count(self, endpoint):
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def _delay(self):
+        median = self.latency_ms / 1000
+        if self.latency == 'fixed':
+            return median
+        if self.latency == 'uniform':
+            return self.rng.uniform(0, 2 * median)
+        return median * math.exp(self.rng.gauss(0, self.latency_sigma))
+
+    @web.middleware
+    async def _inject(self, request, handler):
+        if request.path.startswith('/socket/'):
+            return await handler(request)
+        self._count(request.path.split('/')[2])
+        await asyncio.sleep(self._delay())
+        roll = self.rng.random()
+        if roll < self.throttle_rate:
+            return web.json_response(
+                {'success': False},
+                status=429,
+                headers={'Retry-After': f'{self.retry_after:g}'})
+        if roll < self.throttle_rate + self.error_rate:
+            return web.json_response({'success': False}, status=500)
+        return await handler(request)
+
+    async def _new_listings(self, request):
+        chain = request.match_info['chain']
+        # The client sends naive local times
+        start = datetime.fromisoformat(request.query['from']).timestamp()
+        end = datetime.fromisoformat(request.query['to']).timestamp()
+        first = 0
+        if start >= self.started:
+            first = math.floor((start - self.started) * self.listing_rate) + 1
+        last = min(self.tokens - 1,
+                   math.floor((end - self.started) * self.listing_rate))
+        return web.json_response({
+            'success':
+            True,
+            'data': [{
+                'address': f'{chain}-{index}'
+            } for index in range(first, last + 1)]
+        })
+
+    async def _all_tokens(self, request):
+        chain = request.match_info['chain']
+        offset = int(request.query.get('offset', 0))
+        limit = int(request.query.get('limit', 500))
+        stop = min(offset + limit, self.tokens)
+        return web.json_response({
+            'success': True,
+            'data': {
+                'tokens':
+                [self.token(chain, index)[0] for index in range(offset, stop)]
+            }
+        })
+
+    async def _token(self, request):
+        index = self._index(request)
+        if index is None or index >= self.tokens:
+            return web.json_response({'success': False}, status=404)
+        data, _ = self.token(request.match_info['chain'], index)
+        return web.json_response({'success': True, 'data': data})
+
+    async def _security(self, request):
+        index = self._index(request)
+        if index is None or index >= self.tokens:
+            return web.json_response({'success': False}, status=404)
+        rng = self._token_rng(request.match_info['chain'], index)
+        if rng.random() < self.match_rate:
+            report = {'creator_ownership': 0.5, 'is_secure': True}
+        else:
+            report = {
+                'creator_ownership': rng.uniform(0, 10),
+                'is_secure': rng.random() < 0.5
+            }
+        return web.json_response({'success': True, 'data': report})
+
+    async def _ohlcv(self, request):
+        index = self._index(request)
+        if index is None or index >= self.tokens:
+            return web.json_response({'success': False}, status=404)
+        good = (self._token_rng(request.match_info['chain'], index).random()
+                < self.match_rate)
+        time_from = int(request.query['time_from'])
+        time_to = int(request.query['time_to'])
+        # Tokens scanned in the same minute ask for the same window, so the
+        # two possible bodies are built once per window
+        key = (good, time_from, time_to)
+        body = self.candles.get(key)
+        if body is None:
+            if len(self.candles) >= MAX_CACHED_CANDLES:
+                self.candles.clear()
+            body = self.candles[key] = self._candle_body(
+                good, time_from, time_to)
+        return web.Response(body=body, content_type='application/json')
+
+    def _candle_body(self, good, time_from, time_to):
+        growth = GOOD_GROWTH if good else 1.0
+        first = -(-time_from // CANDLE_STEP) * CANDLE_STEP
+        items = []
+        price = 1.0
+        for unix_time in range(first, time_to, CANDLE_STEP):
+            close = price * growth
+            volume = 20000.0 if good else 500.0
+            items.append({
+                'unixTime': unix_time,
+                'o': price,
+                'c': close,
+                'v': volume,
+                'vUsd': volume * close
+            })
+            price = close
+        return json.dumps({'success': True, 'data': {'items': items}})
+
+    async def _socket(self, request):
+        chain = request.match_info['chain']
+        ws = web.WebSocketResponse(protocols=('echo-protocol', ))
+        await ws.prepare(request)
+        # Subscriptions are accepted without being checked
+        reader = asyncio.create_task(self._discard(ws))
+        index = max(
+            0,
+            math.floor((time.time() - self.started) * self.listing_rate) + 1)
+        try:
+            while index < self.tokens and not ws.closed:
+                await asyncio.sleep(max(0,
+                                        self.listed_at(index) - time.time()))
+                await ws.send_json({
+                    'type': 'TOKEN_NEW_LISTING_DATA',
+                    'data': {
+                        'address': f'{chain}-{index}'
+                    }
+                })
+                index += 1
+        except ConnectionResetError:
+            pass
+        finally:
+            reader.cancel()
+        return ws
+
+    @staticmethod
+    async def _discard(ws):
+        async for _ in ws:
+            pass
+
+
+async def serve(mock, host, port):
+    await mock.start(host, port)
+    print(f"Mock Birdeye on http://{host}:{port} with {mock.tokens} tokens")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await mock.stop()
+
+
+def options(parser):
+    parser.add_argument('--tokens', type=int, default=10000)
+    parser.add_argument('--listing-rate',
+                        type=float,
+                        default=5.0,
+                        help='new listings per second per chain')
+    parser.add_argument('--latency',
+                        choices=('fixed', 'uniform', 'lognormal'),
+                        default='lognormal')
+    parser.add_argument('--latency-ms',
+                        type=float,
+                        default=50.0,
+                        help='median response latency')
+    parser.add_argument('--latency-sigma', type=float, default=0.5)
+    parser.add_argument('--error-rate',
+                        type=float,
+                        default=0.0,
+                        help='share of requests answered with a 500')
+    parser.add_argument('--throttle-rate',
+                        type=float,
+                        default=0.0,
+                        help='share of requests answered with a 429')
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    parser.add_argument('--match-rate', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def from_args(args):
+    return MockBirdeye(args.tokens, args.listing_rate, args.latency,
+                       args.latency_ms, args.latency_sigma, args.error_rate,
+                       args.throttle_rate, args.retry_after, args.match_rate,
+                       args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    options(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(from_args(args), args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
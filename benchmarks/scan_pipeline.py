@@ -0,0 +1,211 @@
+# End-to-end scan benchmark against the local mock Birdeye server. Each scan
+# mode runs in a fresh process, with the mock in another, and reports tokens
+# per second, listing-to-alert latency and the client's peak RSS. Run from
+# the repository root:
+#   python -m benchmarks.scan_pipeline --tokens 100000 --latency-ms 20
+# Results can be appended to a JSON lines file to compare versions:
+#   python -m benchmarks.scan_pipeline --label "$(git rev-parse --short HEAD)" \
+#       --json benchmarks.jsonl
+import argparse
+import asyncio
+import json
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+import yaml
+from benchmarks import mock_birdeye
+from birdeye_api import BirdeyeAPI
+from listing_stream import ListingStream
+from scheduler import ChainScheduler
+from token_scanner import TokenScanner
+
+MODES = ('new_listings', 'push', 'all_tokens')
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def _serve_mock(args, port, conn):
+    # Runs in its own process until the parent asks for the request counts
+
+    async def run():
+        mock = mock_birdeye.from_args(args)
+        await mock.start('127.0.0.1', port)
+        conn.send(mock.started)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, conn.recv)
+        conn.send(mock.requests)
+        await mock.stop()
+
+    asyncio.run(run())
+
+
+def _run_client(mode, args, port, listing_start):
+    return asyncio.run(_client(mode, args, port, listing_start))
+
+
+async def _client(mode, args, port, listing_start):
+    with open(args.config, 'r') as file:
+        criteria = yaml.safe_load(file)['filter_criteria']
+    api = BirdeyeAPI('benchmark', {}, {
+        'requests_per_second': args.rps,
+        'burst': args.rps,
+        'backoff_base': 0.05
+    }, None, None, 60, {'hedging': args.hedging})
+    api.base_url = f'http://127.0.0.1:{port}'
+    await api.start()
+    scanner = TokenScanner(api, criteria, mode != 'all_tokens',
+                           args.concurrency, '1m', 5000, None, {},
+                           args.page_size)
+    chains = args.chains.split(',')
+    latencies = []
+    matches = 0
+    tokens = 0
+
+    def alerted(address):
+        index = int(address.rsplit('-', 1)[1])
+        latencies.append(time.time() - listing_start -
+                         index / args.listing_rate)
+
+    started = time.perf_counter()
+    try:
+        if mode == 'all_tokens':
+            # Full passes over the universe; later ones skip unchanged tokens
+            for _ in range(args.scans):
+                async for _ in scanner.stream_tokens(chains):
+                    matches += 1
+                tokens += args.tokens * len(chains)
+        elif mode == 'push':
+
+            async def on_listing(chain, address):
+                nonlocal matches
+                if await scanner.evaluate_listing(chain, address):
+                    matches += 1
+                    alerted(address)
+
+            stream = ListingStream(api,
+                                   chains,
+                                   on_listing,
+                                   url=f'ws://127.0.0.1:{port}/socket')
+            try:
+                await asyncio.wait_for(stream.run(), args.duration)
+            except asyncio.TimeoutError:
+                pass
+            tokens = stream.received + stream.backfilled
+        else:
+
+            async def scan(chain):
+                nonlocal matches, tokens
+                async for _, address, _, _ in scanner.stream_tokens([chain]):
+                    matches += 1
+                    alerted(address)
+                listings = scanner.listing_counts.pop(chain, None)
+                tokens += listings or 0
+                return listings
+
+            scheduler = ChainScheduler(scan, chains, args.interval)
+            try:
+                await asyncio.wait_for(scheduler.run(), args.duration)
+            except asyncio.TimeoutError:
+                pass
+        elapsed = time.perf_counter() - started
+    finally:
+        await api.close()
+    return {
+        'mode': mode,
+        'tokens': tokens,
+        'seconds': elapsed,
+        'tokens_per_second': tokens / elapsed if elapsed else 0.0,
+        'matches': matches,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p90': percentile(latencies, 0.9),
+        'latency_p99': percentile(latencies, 0.99),
+        'latency_max': max(latencies, default=None),
+        'requests': api.requests,
+        'peak_rss_mib':
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+
+def run_mode(mode, args, port):
+    # The mock's listing clock starts with each mode, so every mode sees
+    # the same listing schedule
+    context = multiprocessing.get_context('spawn')
+    parent, child = context.Pipe()
+    server = context.Process(target=_serve_mock, args=(args, port, child))
+    server.start()
+    try:
+        listing_start = parent.recv()
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            result = pool.submit(_run_client, mode, args, port,
+                                 listing_start).result()
+        parent.send('stop')
+        served = parent.recv()
+    finally:
+        server.join(5)
+        if server.is_alive():
+            server.terminate()
+    result['served'] = sum(served.values())
+    return result
+
+
+def _seconds(value):
+    return f"{value:.3f}" if value is not None else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--chains', default='solana')
+    parser.add_argument('--duration',
+                        type=float,
+                        default=30,
+                        help='seconds each listing mode runs')
+    parser.add_argument('--interval',
+                        type=float,
+                        default=5,
+                        help='new_listings scan interval in seconds')
+    parser.add_argument('--scans',
+                        type=int,
+                        default=2,
+                        help='full all_tokens scans')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--rps', type=float, default=1000)
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--hedging', action='store_true')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--config', default='config.yaml')
+    parser.add_argument('--label', default='', help='e.g. the git revision')
+    parser.add_argument('--json', help='append the results to this file')
+    mock_birdeye.options(parser)
+    args = parser.parse_args()
+
+    print(f"{'mode':<13}{'tokens':>9}{'tokens/s':>10}{'matches':>9}"
+          f"{'p50 s':>8}{'p90 s':>8}{'p99 s':>8}{'requests':>10}"
+          f"{'RSS MiB':>9}")
+    for mode in args.modes.split(','):
+        result = run_mode(mode, args, args.port)
+        print(f"{mode:<13}{result['tokens']:>9}"
+              f"{result['tokens_per_second']:>10.1f}{result['matches']:>9}"
+              f"{_seconds(result['latency_p50']):>8}"
+              f"{_seconds(result['latency_p90']):>8}"
+              f"{_seconds(result['latency_p99']):>8}"
+              f"{result['requests']:>10}{result['peak_rss_mib']:>9.1f}")
+        if args.json:
+            with open(args.json, 'a') as file:
+                file.write(
+                    json.dumps({
+                        'label': args.label,
+                        'time': time.time(),
+                        'options': vars(args),
+                        **result
+                    }) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Compares raw token payload dicts with TokenRecord/SecurityReport: memory
+# per token, decoding and field access. Run from the repository root:
+#   python -m benchmarks.token_records --tokens 100000
+import argparse
+import json
+import time
+import tracemalloc
+import records
+from benchmarks.filter_batch import synthetic_payloads
+from records import SecurityReport, TokenRecord
+
+
+def allocated(build):
+    tracemalloc.start()
+    value = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return value, size
+
+
+def timed(run, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        run()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tokens', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    payloads, _, reports = synthetic_payloads(args.tokens, [], args.seed)
+    # Birdeye payloads carry more than the filter reads
+    for payload in payloads:
+        payload.update({
+            'symbol': 'TKN',
+            'decimals': 9,
+            'price': 0.0123,
+            'volume': {
+                'h1': 1000.0,
+                'h24': 25000.0
+            },
+            'priceChange': {
+                'h1': 1.5,
+                'h24': 12.5
+            },
+            'extensions': {
+                'website': 'https://example.com',
+                'twitter': 'https://x.com/example'
+            },
+            'logoURI': 'https://example.com/logo.png'
+        })
+    body = json.dumps({'data': payloads}).encode()
+
+    dicts, dict_bytes = allocated(lambda: json.loads(body)['data'])
+    tokens, record_bytes = allocated(
+        lambda: [TokenRecord.from_dict(payload) for payload in dicts])
+    _, report_dict_bytes = allocated(lambda: json.loads(json.dumps(reports)))
+    _, report_bytes = allocated(
+        lambda: [SecurityReport.from_dict(report) for report in reports])
+
+    json_time = timed(lambda: json.loads(body), args.repeat)
+    fast_time = timed(lambda: records.loads(body), args.repeat)
+    parse_time = timed(
+        lambda: [TokenRecord.from_dict(payload) for payload in dicts],
+        args.repeat)
+    dict_access = timed(
+        lambda: [(payload.get('liquidity', 0), payload.get('marketCap', 0),
+                  payload.get('totalSupply', 0))
+                 for payload in dicts], args.repeat)
+    record_access = timed(
+        lambda: [(token.liquidity, token.market_cap, token.total_supply)
+                 for token in tokens], args.repeat)
+
+    decoder = 'orjson' if records.orjson is not None else 'json'
+    print(f"tokens:            {args.tokens}")
+    print(f"token dict:        {dict_bytes / args.tokens:.0f} B/token")
+    print(f"TokenRecord:       {record_bytes / args.tokens:.0f} B/token")
+    print(f"security dict:     {report_dict_bytes / args.tokens:.0f} B/token")
+    print(f"SecurityReport:    {report_bytes / args.tokens:.0f} B/token")
+    print(f"json decode:       {json_time * 1000:.1f} ms")
+    print(f"{decoder} decode:".ljust(19) + f"{fast_time * 1000:.1f} ms")
+    print(f"record parse:      {parse_time * 1000:.1f} ms")
+    print(f"dict access:       {dict_access * 1000:.2f} ms")
+    print(f"record access:     {record_access * 1000:.2f} ms "
+          f"({dict_access / record_access:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,502 @@
 import aiohttp
-from datetime import datetime, timedelta
+import asyncio
+import random
+from contextlib import aclosing
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import ohlcv
+from metrics import DISABLED
+from rate_limiter import PRIORITY_HIGH, PRIORITY_NORMAL, TokenBucket
+from records import SecurityReport, TokenRecord, loads
+from resilience import CircuitBreaker, HedgeBudget, LatencyTracker
+from response_cache import ResponseCache
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Cached endpoints keyed by (chain, address) whose responses are persisted
+PERSISTED_ENDPOINTS = {'token', 'token_security'}
+
+
+class _Flight:
+
+    __slots__ = ('task', 'waiters')
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
 
 
 class BirdeyeAPI:
 
-    def __init__(self, api_key):
+    def __init__(self,
+                 api_key,
+                 http_settings=None,
+                 rate_limit=None,
+                 cache_settings=None,
+                 state_store=None,
+                 max_backfill_minutes=60,
+                 resilience_settings=None,
+                 recorder=None,
+                 metrics=None):
         self.api_key = api_key
         self.base_url = "https://public-api.birdeye.so"
-        self.last_scan_time = datetime.now() - timedelta(minutes=5)
+        # New-listing cursors per chain; kept in the state store, if any, so
+        # a restart resumes where the previous run stopped
+        self.last_scan_times = {}
+        self.state_store = state_store
+        self.max_backfill = timedelta(minutes=max_backfill_minutes)
+        self.http_settings = http_settings or {}
+        self.session = None
+        rate_limit = rate_limit or {}
+        self.rate_limiter = TokenBucket(
+            rate_limit.get('requests_per_second', 15), rate_limit.get('burst'))
+        self.max_retries = rate_limit.get('max_retries', 4)
+        self.backoff_base = rate_limit.get('backoff_base', 0.5)
+        self.backoff_max = rate_limit.get('backoff_max', 30)
+        cache_settings = cache_settings or {}
+        self.cache = ResponseCache(
+            cache_settings.get('ttl', {
+                'token': 30,
+                'token_security': 3600
+            }), cache_settings.get('max_entries', 50000),
+            cache_settings.get('max_bytes', 64 * 1024 * 1024))
+        # Identical requests in flight share one call (path, params) -> flight
+        self.in_flight = {}
+        self.requests = 0  # distinct calls made
+        self.coalesced = 0  # calls answered by a request already in flight
+        # Per endpoint: rolling latency for hedging slow calls and a circuit
+        # breaker that fails calls fast while the endpoint is unhealthy
+        resilience_settings = resilience_settings or {}
+        self.hedging = resilience_settings.get('hedging', False)
+        self.hedge_percentile = resilience_settings.get(
+            'hedge_percentile', 0.95)
+        self.hedge_budget = HedgeBudget(
+            resilience_settings.get('hedge_ratio', 0.05),
+            resilience_settings.get('hedge_burst', 5))
+        self.latency_window = resilience_settings.get('latency_window', 200)
+        self.failure_threshold = resilience_settings.get(
+            'failure_threshold', 5)
+        self.reset_timeout = resilience_settings.get('reset_timeout', 30)
+        self.latencies = {}
+        self.breakers = {}
+        self.hedges = 0
+        self.hedge_wins = 0  # hedges that answered before the original call
+        # Appends every response to a log for offline backtests, if set
+        self.recorder = recorder
+        metrics = metrics or DISABLED
+        self.request_seconds = metrics.histogram(
+            'birdeye_request_seconds',
+            'Birdeye call latency per endpoint, including retries and hedges',
+            ('endpoint', ))
+        self.responses = metrics.counter(
+            'birdeye_responses_total',
+            'Birdeye responses per endpoint and HTTP status, or error for '
+            'connection failures and timeouts', ('endpoint', 'status'))
+        metrics.collect(self._collect_metrics)
+
+    async def start(self):
+        if self.session is not None and not self.session.closed:
+            return
+        settings = self.http_settings
+        connector = aiohttp.TCPConnector(
+            limit=settings.get('max_connections', 100),
+            limit_per_host=settings.get('max_connections_per_host', 20),
+            ttl_dns_cache=settings.get('dns_cache_ttl', 300),
+            keepalive_timeout=settings.get('keepalive_timeout', 30))
+        timeout = aiohttp.ClientTimeout(
+            total=settings.get('total_timeout', 30),
+            connect=settings.get('connect_timeout', 10),
+            sock_read=settings.get('read_timeout', 20))
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            headers={"X-API-KEY": self.api_key})
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'coalesced': self.coalesced,
+            'in_flight': len(self.in_flight),
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'breakers': {
+                endpoint: breaker.state
+                for endpoint, breaker in self.breakers.items()
+            },
+            'cache': self.cache.stats()
+        }
+
+    def _collect_metrics(self):
+        in_flight = {}
+        for path, _ in self.in_flight:
+            endpoint = path.split('/')[2]
+            in_flight[endpoint] = in_flight.get(endpoint, 0) + 1
+        yield ('gauge', 'birdeye_in_flight',
+               'Distinct Birdeye calls in flight per endpoint', [
+                   (dict(endpoint=endpoint), count)
+                   for endpoint, count in in_flight.items()
+               ])
+        calls = (('requested', self.requests), ('coalesced', self.coalesced),
+                 ('hedged', self.hedges), ('hedge_won', self.hedge_wins))
+        yield ('counter', 'birdeye_calls_total',
+               'Birdeye calls by how they were answered', [
+                   (dict(outcome=outcome), count) for outcome, count in calls
+               ])
+        breakers = self.breakers.items()
+        yield ('gauge', 'birdeye_circuit_open',
+               'Whether calls to the endpoint fail fast (1) or not (0)', [
+                   (dict(endpoint=endpoint),
+                    int(breaker.state != CircuitBreaker.CLOSED))
+                   for endpoint, breaker in breakers
+               ])
+        yield ('counter', 'birdeye_circuit_rejected_total',
+               'Calls failed fast by an open circuit', [
+                   (dict(endpoint=endpoint), breaker.rejected)
+                   for endpoint, breaker in breakers
+               ])
+        yield ('counter', 'birdeye_requests_granted_total',
+               'Requests let through by the client-side rate limit', [
+                   ({}, self.rate_limiter.granted)
+               ])
+        cache = self.cache.stats()
+        lookups = [(dict(endpoint=endpoint, result=result), count)
+                   for result, field in (('hit', 'hits'), ('miss', 'misses'))
+                   for endpoint, count in cache[field].items()]
+        yield ('counter', 'birdeye_cache_lookups_total',
+               'Response cache lookups per endpoint and result', lookups)
+
+    async def _get(self, path, params=None, priority=PRIORITY_NORMAL):
+        # Callers of an identical request get the result or error of the one
+        # already in flight. The call is shielded from a caller giving up and
+        # only cancelled once every caller has.
+        key = (path, tuple(sorted(params.items())) if params else ())
+        flight = self.in_flight.get(key)
+        if flight is None:
+            flight = _Flight(
+                asyncio.ensure_future(self._call(path, params, priority)))
+            self.in_flight[key] = flight
+            flight.task.add_done_callback(lambda _: self._land(key, flight))
+            self.requests += 1
+        else:
+            self.coalesced += 1
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                # Forget the flight first, so a caller arriving before the
+                # task finishes cancelling starts a new one instead of
+                # joining a cancelled task
+                self._land(key, flight)
+                flight.task.cancel()
+
+    def _land(self, key, flight):
+        if self.in_flight.get(key) is flight:
+            del self.in_flight[key]
+
+    async def _call(self, path, params, priority):
+        endpoint = path.split('/')[2]  # /public/<endpoint>/...
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            breaker = self.breakers[endpoint] = CircuitBreaker(
+                endpoint, self.failure_threshold, self.reset_timeout)
+        breaker.check()
+        try:
+            result = await self._hedged(endpoint, path, params, priority)
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception as e:
+            # Only outages count against the endpoint; e.g. a 404 for an
+            # unknown token shows the endpoint is answering
+            if _is_outage(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        breaker.record_success()
+        if self.recorder is not None:
+            self.recorder.record(path, params, result)
+        return result
+
+    async def _hedged(self, endpoint, path, params, priority):
+        # Once a call takes longer than the endpoint's rolling percentile, a
+        # second copy goes out if the hedge budget allows, and the first
+        # successful answer wins
+        latency = self.latencies.get(endpoint)
+        if latency is None:
+            latency = self.latencies[endpoint] = LatencyTracker(
+                self.latency_window)
+        delay = None
+        if self.hedging:
+            self.hedge_budget.earn()
+            delay = latency.percentile(self.hedge_percentile)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        tasks = [asyncio.ensure_future(self._fetch(path, params, priority))]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self.hedge_budget.take():
+                    self.hedges += 1
+                    tasks.append(
+                        asyncio.ensure_future(
+                            self._fetch(path, params, priority)))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.hedge_wins += 1
+                        elapsed = loop.time() - started
+                        latency.record(elapsed)
+                        self.request_seconds.labels(endpoint).observe(elapsed)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _fetch(self, path, params=None, priority=PRIORITY_NORMAL):
+        if self.session is None or self.session.closed:
+            await self.start()
+        url = f"{self.base_url}{path}"
+        endpoint = path.split('/')[2]
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire(priority)
+            try:
+                async with self.session.get(url, params=params) as response:
+                    self.responses.labels(endpoint, str(response.status)).inc()
+                    if response.status not in RETRY_STATUSES:
+                        response.raise_for_status()
+                        self.rate_limiter.reward()
+                        return loads(await response.read())
+                    if attempt == self.max_retries:
+                        response.raise_for_status()
+                    retry_after = self._retry_after(response)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self.responses.labels(endpoint, 'error').inc()
+                if attempt == self.max_retries:
+                    raise
+                retry_after = None
+                response = None
+
+            delay = self._backoff(attempt, retry_after)
+            if response is not None and response.status == 429:
+                self.rate_limiter.throttle(delay)
+            await asyncio.sleep(delay)
+
+    def _backoff(self, attempt, retry_after=None):
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        delay = random.uniform(delay / 2, delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    @staticmethod
+    def _retry_after(response):
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+    async def _get_cached(self, endpoint, key, path, params, parse):
+        # Responses are parsed into records before they are cached, so only
+        # the fields the scanner uses are kept
+        cached = self.cache.enabled(endpoint)
+        # Per-token responses are also snapshotted in the state store, which
+        # warms the cache after a restart
+        persisted = (cached and self.state_store is not None
+                     and endpoint in PERSISTED_ENDPOINTS)
+        if cached:
+            result = self.cache.get(endpoint, key)
+            if result is not None:
+                return result
+        if persisted:
+            snapshot = self.state_store.get_snapshot(*key, endpoint,
+                                                     self.cache.ttls[endpoint])
+            if snapshot is not None:
+                data, age = snapshot
+                result = parse(data)
+                self.cache.put(endpoint, key, result, age)
+                return result
+        data = await self._get(path, params)
+        data = data.get('data', {})  # Assuming the API returns a 'data' field
+        result = parse(data)
+        if cached:
+            self.cache.put(endpoint, key, result)
+        if persisted:
+            self.state_store.save_snapshot(*key, endpoint, data)
+        return result
 
     async def get_token_data(self, chain, address):
-        async with aiohttp.ClientSession() as session:
-            headers = {"X-API-KEY": self.api_key}
-            url = f"{self.base_url}/public/token/{chain}/{address}"
-            async with session.get(url, headers=headers) as response:
-                data = await response.json()
-                return data.get('data',
-                                {})  # Assuming the API returns a 'data' field
+        return await self._get_cached(
+            'token', (chain, address), f"/public/token/{chain}/{address}",
+            None, lambda data: TokenRecord.from_dict(data, chain, address))
 
     async def get_new_listings(self, chain):
+        listings, _ = await self.fetch_new_listings(chain)
+        return listings
+
+    async def fetch_new_listings(self, chain):
+        # Returns the listings since the chain's cursor and the end of the
+        # window fetched, which the caller passes to advance_cursor once
+        # they are evaluated; until then a restart or a failed scan fetches
+        # them again
         current_time = datetime.now()
-        async with aiohttp.ClientSession() as session:
-            headers = {"X-API-KEY": self.api_key}
-            url = f"{self.base_url}/public/new_listings/{chain}"
-            params = {
-                "from": self.last_scan_time.isoformat(),
-                "to": current_time.isoformat()
+        params = {
+            "from": self._scan_cursor(chain, current_time).isoformat(),
+            "to": current_time.isoformat()
+        }
+        data = await self._get(f"/public/new_listings/{chain}", params,
+                               PRIORITY_HIGH)
+        new_listings = data.get('data',
+                                [])  # Assuming the API returns a 'data' field
+        return new_listings, current_time
+
+    def advance_cursor(self, chain, current_time):
+        # Listings up to current_time have been seen. The listing stream and
+        # the poller both move the cursor, so it never goes back: listings
+        # behind it were evaluated by whichever moved it there.
+        last_scan_time = self._last_scan_time(chain)
+        if last_scan_time is not None and last_scan_time >= current_time:
+            return
+        self.last_scan_times[chain] = current_time
+        if self.state_store is not None:
+            self.state_store.set_cursor(chain, current_time.isoformat())
+
+    def _last_scan_time(self, chain):
+        last_scan_time = self.last_scan_times.get(chain)
+        if last_scan_time is None and self.state_store is not None:
+            stored = self.state_store.get_cursor(chain)
+            if stored is not None:
+                last_scan_time = datetime.fromisoformat(stored)
+                self.last_scan_times[chain] = last_scan_time
+        return last_scan_time
+
+    def _scan_cursor(self, chain, current_time):
+        last_scan_time = self._last_scan_time(chain)
+        if last_scan_time is None:
+            return current_time - timedelta(minutes=5)
+        # After a long outage only the most recent listings are backfilled
+        return max(last_scan_time, current_time - self.max_backfill)
+
+    async def get_all_tokens(self, chain, page_size=500):
+        # Collects every page: {address: TokenRecord} while the pages are
+        # dicts, or a list of the entries of list pages. Once a list page
+        # comes up, dict pages add their addresses to the list instead.
+        tokens = {}
+        listed = None
+        async with aclosing(self.iter_all_tokens(chain, page_size)) as pages:
+            async for page in pages:
+                if isinstance(page, list):
+                    if listed is None:
+                        listed = list(tokens)
+                    listed.extend(page)
+                elif listed is not None:
+                    listed.extend(page)
+                else:
+                    tokens.update(page)
+        return tokens if listed is None else listed
+
+    async def iter_all_tokens(self, chain, page_size=500, owns_page=None):
+        # Yields the chain's tokens a page at a time, as {address:
+        # TokenRecord}. The next page downloads while the caller works on the
+        # current one, so at most two pages are held at once. With owns_page,
+        # only the page numbers it accepts are fetched (a shard of the chain).
+        page = _next_page(-1, owns_page)
+        fetch = asyncio.ensure_future(
+            self._all_tokens_page(chain, page * page_size, page_size))
+        try:
+            while fetch is not None:
+                tokens, count = await fetch
+                # A short page is the last one; a longer one means the
+                # endpoint ignored the paging and returned everything
+                fetch = None
+                if count == page_size:
+                    page = _next_page(page, owns_page)
+                    fetch = asyncio.ensure_future(
+                        self._all_tokens_page(chain, page * page_size,
+                                              page_size))
+                if count:
+                    yield tokens
+        finally:
+            if fetch is not None:
+                fetch.cancel()
+
+    async def _all_tokens_page(self, chain, offset, limit):
+        data = await self._get(f"/public/all_tokens/{chain}", {
+            "offset": offset,
+            "limit": limit
+        }, PRIORITY_HIGH)
+        tokens = data.get('data',
+                          {})  # Assuming the API returns a 'data' field
+        if isinstance(tokens, dict) and isinstance(tokens.get('tokens'), list):
+            # Token list pages carry the token data with its address
+            tokens = {
+                token['address']: token
+                for token in tokens['tokens']
+                if isinstance(token, dict) and 'address' in token
             }
-            async with session.get(url, headers=headers,
-                                   params=params) as response:
-                data = await response.json()
-                new_listings = data.get(
-                    'data', [])  # Assuming the API returns a 'data' field
-        self.last_scan_time = current_time
-        return new_listings
-
-    async def get_all_tokens(self, chain):
-        async with aiohttp.ClientSession() as session:
-            headers = {"X-API-KEY": self.api_key}
-            url = f"{self.base_url}/public/all_tokens/{chain}"
-            async with session.get(url, headers=headers) as response:
-                data = await response.json()
-                return data.get('data',
-                                {})  # Assuming the API returns a 'data' field
+        if isinstance(tokens, dict):
+            return {
+                address: TokenRecord.from_dict(token_data, chain, address)
+                for address, token_data in tokens.items()
+            }, len(tokens)
+        if isinstance(tokens, list):
+            return tokens, len(tokens)
+        return {}, 0
 
     async def get_token_security(self, chain, address):
-        async with aiohttp.ClientSession() as session:
-            headers = {"X-API-KEY": self.api_key}
-            url = f"{self.base_url}/public/token_security/{chain}/{address}"
-            async with session.get(url, headers=headers) as response:
-                data = await response.json()
-                return data.get('data',
-                                {})  # Assuming the API returns a 'data' field
-
-    async def get_ohlcv(self, chain, address, interval):
-        async with aiohttp.ClientSession() as session:
-            headers = {"X-API-KEY": self.api_key}
-            url = f"{self.base_url}/public/ohlcv/{chain}/{address}"
-            params = {"interval": interval}
-            async with session.get(url, headers=headers,
-                                   params=params) as response:
-                data = await response.json()
-                return data.get('data',
-                                {})  # Assuming the API returns a 'data' field
+        return await self._get_cached(
+            'token_security', (chain, address),
+            f"/public/token_security/{chain}/{address}", None,
+            SecurityReport.from_dict)
+
+    async def get_ohlcv(self,
+                        chain,
+                        address,
+                        interval,
+                        time_from=None,
+                        time_to=None):
+        params = {"interval": interval}
+        if time_from is not None:
+            params["time_from"] = int(time_from)
+        if time_to is not None:
+            params["time_to"] = int(time_to)
+        return await self._get_cached(
+            'ohlcv', (chain, address, interval, time_from, time_to),
+            f"/public/ohlcv/{chain}/{address}", params, ohlcv.parse_candles)
+
+
+def _next_page(page, owns_page):
+    page += 1
+    while owns_page is not None and not owns_page(page):
+        page += 1
+    return page
+
+
+def _is_outage(error):
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRY_STATUSES
+    return isinstance(error,
+                      (aiohttp.ClientConnectionError, asyncio.TimeoutError))
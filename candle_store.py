@@ -0,0 +1,257 @@
+from array import array
+from collections import OrderedDict
+import ohlcv
+
+
+class _Window:
+
+    __slots__ = ('span', 'head', 'volume', 'volume_usd', 'moving_volume')
+
+    def __init__(self, span, head):
+        self.span = span
+        self.head = head  # sequence number of the oldest candle in the window
+        self.volume = 0.0
+        self.volume_usd = 0.0
+        self.moving_volume = 0.0  # volume of candles with a price change
+
+
+# Bytes per stored candle: six 8-byte columns
+CANDLE_BYTES = 48
+# Slots a new series starts with; a freshly listed token has few candles
+INITIAL_CAPACITY = 16
+
+
+class RollingCandles:
+
+    # Columns grow by doubling, up to limit candles (the longest window at
+    # base resolution), so young tokens and sparse series stay small.
+    # on_grow(added_bytes) is called after every growth.
+
+    def __init__(self, base_seconds, limit, on_grow=None):
+        self.base_seconds = base_seconds
+        self.limit = limit
+        self.on_grow = on_grow
+        capacity = self.capacity = min(limit, INITIAL_CAPACITY)
+        self.times = array('q', bytes(8 * capacity))
+        self.opens = array('d', bytes(8 * capacity))
+        self.closes = array('d', bytes(8 * capacity))
+        self.volumes = array('d', bytes(8 * capacity))
+        self.volumes_usd = array('d', bytes(8 * capacity))
+        self.changes = array('d', bytes(8 * capacity))
+        # Candles are numbered in arrival order; a candle lives in slot
+        # seq % capacity for as long as first <= seq < next
+        self.first = 0
+        self.next = 0
+        self.end = 0
+        self.covered_from = None
+        self.windows = {}
+
+    def __len__(self):
+        return self.next - self.first
+
+    @property
+    def nbytes(self):
+        return self.capacity * CANDLE_BYTES
+
+    def fetch_from(self, end, span):
+        # Start of the range the next fetch has to cover. Only the last
+        # candle is refetched while it may still be forming, unless the series
+        # does not reach back far enough for the longest window yet.
+        if self.covered_from is None or self.covered_from > end - span:
+            return end - span
+        if self.next == self.first:
+            return max(self.end, end - span)
+        return self.times[(self.next - 1) % self.capacity]
+
+    def update(self, candles, time_from, end):
+        if self.covered_from is None or time_from < self.covered_from:
+            if self.covered_from is not None:
+                self._clear()
+            self.covered_from = time_from
+        for i in range(len(candles)):
+            self._upsert(candles, i)
+        self._advance(end)
+
+    def ensure_windows(self, intervals):
+        for interval in intervals:
+            if interval in self.windows:
+                continue
+            span = ohlcv.interval_seconds(interval)
+            self.limit = max(self.limit, span // self.base_seconds + 1)
+            window = _Window(span, self.first)
+            for seq in range(self.first, self.next):
+                self._add(window, seq % self.capacity, 1)
+            self.windows[interval] = window
+            self._advance_window(window, self.end)
+
+    def summaries(self, intervals):
+        return {interval: self.summary(interval) for interval in intervals}
+
+    def summary(self, interval):
+        window = self.windows[interval]
+        if window.head >= self.next:
+            return ohlcv.summarize([])
+        head = window.head % self.capacity
+        valid_volume = window.moving_volume
+        if self.changes[head] != 0:
+            # The first candle of a window never counts as valid volume
+            valid_volume -= self.volumes[head]
+        return {
+            'volume':
+            window.volume,
+            'volume_usd':
+            window.volume_usd,
+            'price_change_percent':
+            ohlcv.percent_change(self.opens[head],
+                                 self.closes[(self.next - 1) % self.capacity]),
+            'valid_volume':
+            valid_volume
+        }
+
+    def _upsert(self, candles, i):
+        unix_time = candles.times[i]
+        if self.next > self.first:
+            last_time = self.times[(self.next - 1) % self.capacity]
+            if unix_time <= last_time:
+                # Only the newest candles change between scans; replace the
+                # stored candle with the same open time, if any
+                seq = self._find(unix_time)
+                if seq is not None:
+                    self._replace(seq, candles, i)
+                return
+        if self.next - self.first == self.capacity:
+            if self.capacity < self.limit:
+                self._resize(min(self.limit, 2 * self.capacity))
+            else:
+                self._drop_oldest()
+        seq = self.next
+        self._write(seq % self.capacity, candles, i)
+        self.next += 1
+        for window in self.windows.values():
+            self._add(window, seq % self.capacity, 1)
+
+    def _find(self, unix_time):
+        low, high = self.first, self.next
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[middle % self.capacity] < unix_time:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.next and self.times[low % self.capacity] == unix_time:
+            return low
+        return None
+
+    def _replace(self, seq, candles, i):
+        slot = seq % self.capacity
+        windows = [
+            window for window in self.windows.values() if window.head <= seq
+        ]
+        for window in windows:
+            self._add(window, slot, -1)
+        self._write(slot, candles, i)
+        for window in windows:
+            self._add(window, slot, 1)
+
+    def _write(self, slot, candles, i):
+        # Copies candle i of a CandleSeries into a slot
+        self.times[slot] = candles.times[i]
+        self.opens[slot] = candles.opens[i]
+        self.closes[slot] = candles.closes[i]
+        self.volumes[slot] = candles.volumes[i]
+        self.volumes_usd[slot] = candles.volumes_usd[i]
+        self.changes[slot] = candles.changes[i]
+
+    def _add(self, window, slot, sign):
+        volume = self.volumes[slot] * sign
+        window.volume += volume
+        window.volume_usd += self.volumes_usd[slot] * sign
+        if self.changes[slot] != 0:
+            window.moving_volume += volume
+
+    def _advance(self, end):
+        self.end = max(self.end, end)
+        for window in self.windows.values():
+            self._advance_window(window, self.end)
+
+    def _advance_window(self, window, end):
+        start = end - window.span
+        while (window.head < self.next
+               and self.times[window.head % self.capacity] < start):
+            self._add(window, window.head % self.capacity, -1)
+            window.head += 1
+        if window.head >= self.next:
+            # Reset empty windows so rounding errors do not accumulate
+            window.volume = window.volume_usd = window.moving_volume = 0.0
+
+    def _drop_oldest(self):
+        for window in self.windows.values():
+            if window.head == self.first:
+                self._add(window, self.first % self.capacity, -1)
+                window.head += 1
+        self.first += 1
+
+    def _clear(self):
+        self.first = self.next
+        for window in self.windows.values():
+            window.head = self.next
+            window.volume = window.volume_usd = window.moving_volume = 0.0
+
+    def _resize(self, capacity):
+        columns = ('times', 'opens', 'closes', 'volumes', 'volumes_usd',
+                   'changes')
+        for name in columns:
+            old = getattr(self, name)
+            new = array(old.typecode, bytes(8 * capacity))
+            for seq in range(self.first, self.next):
+                new[seq % capacity] = old[seq % self.capacity]
+            setattr(self, name, new)
+        added = (capacity - self.capacity) * CANDLE_BYTES
+        self.capacity = capacity
+        if self.on_grow is not None:
+            self.on_grow(added)
+
+
+class CandleStore:
+
+    # Least recently used series are evicted beyond max_tokens series or
+    # max_bytes of candle columns
+
+    def __init__(self,
+                 base_seconds,
+                 max_tokens=5000,
+                 max_bytes=64 * 1024 * 1024):
+        self.base_seconds = base_seconds
+        self.max_tokens = max_tokens
+        self.max_bytes = max_bytes
+        self.series = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, chain, address, intervals):
+        key = (chain, address)
+        series = self.series.get(key)
+        if series is None:
+            span = max(
+                ohlcv.interval_seconds(interval) for interval in intervals)
+            series = RollingCandles(self.base_seconds,
+                                    span // self.base_seconds + 1, self._grown)
+            self.series[key] = series
+            self.nbytes += series.nbytes
+            self._evict()
+        else:
+            self.series.move_to_end(key)
+        series.ensure_windows(intervals)
+        return series
+
+    def _grown(self, added):
+        self.nbytes += added
+        self._evict()
+
+    def _evict(self):
+        # The most recently used series is kept even if it alone is too big
+        while len(self.series) > 1 and (len(self.series) > self.max_tokens
+                                        or self.nbytes > self.max_bytes):
+            _, series = self.series.popitem(last=False)
+            # An evaluation may still be updating it; it no longer counts
+            series.on_grow = None
+            self.nbytes -= series.nbytes
@@ -0,0 +1,266 @@
+import copy
+import time
+from bisect import bisect_left, bisect_right
+from token_filter import ENRICHED_CHECKS, TOKEN_CHECKS, TokenFilter
+
+
+class _Thresholds:
+
+    # Profiles are bits of an int mask. For any value, the profiles whose
+    # threshold it satisfies are found with one bisect over the sorted
+    # thresholds and a precomputed prefix (lower bounds) or suffix (upper
+    # bounds) mask. Profiles without this threshold are always in `free`.
+
+    def __init__(self, entries, upper=False, free=0):
+        entries = sorted(entries)
+        self.upper = upper
+        self.free = free
+        self.thresholds = [threshold for threshold, _ in entries]
+        masks = [0]
+        bits = [bit for _, bit in entries]
+        for bit in (reversed(bits) if upper else bits):
+            masks.append(masks[-1] | bit)
+        self.masks = masks[::-1] if upper else masks
+
+    def passing(self, value):
+        if self.upper:
+            return self.free | self.masks[bisect_left(self.thresholds, value)]
+        return self.free | self.masks[bisect_right(self.thresholds, value)]
+
+
+class ProfileIndex:
+
+    # Index over the active profiles' plans; evaluating a token costs a few
+    # bisects per check instead of one pass per profile. The outcome of each
+    # check is counted in every profile's TokenFilter.
+
+    def __init__(self, filters):
+        self.keys = list(filters)
+        self.filters = filters
+        # With a single profile the scanner uses its TokenFilter directly
+        self.single = filters[self.keys[0]] if len(filters) == 1 else None
+        self.all = (1 << len(self.keys)) - 1
+        plans = [(1 << i, filters[key].plan)
+                 for i, key in enumerate(self.keys)]
+
+        self.liquidity = _Thresholds([(plan.min_liquidity, bit)
+                                      for bit, plan in plans])
+        self.min_market_cap = _Thresholds([(plan.min_market_cap, bit)
+                                           for bit, plan in plans])
+        self.max_market_cap = _Thresholds([(plan.max_market_cap, bit)
+                                           for bit, plan in plans],
+                                          upper=True)
+        self.first_mint_time = _Thresholds([(plan.first_mint_time, bit)
+                                            for bit, plan in plans])
+        self.supply_traded = _Thresholds([(plan.min_supply_traded, bit)
+                                          for bit, plan in plans])
+
+        enabled = {
+            bit: {name
+                  for name, _, _ in plan.enriched_checks}
+            for bit, plan in plans
+        }
+        ownership = [(plan.max_creator_ownership, bit) for bit, plan in plans
+                     if 'creator_ownership' in enabled[bit]]
+        self.creator_ownership = _Thresholds(
+            ownership,
+            upper=True,
+            free=self.all & ~sum(bit for _, bit in ownership))
+        self.security_required = sum(bit for bit, plan in plans
+                                     if plan.token_security)
+        self.windows = {}
+        for field, attribute in (('valid_volume', 'min_volume'),
+                                 ('volume_usd', 'min_volume_usd'),
+                                 ('price_change_percent', 'min_price_change')):
+            self.windows[field] = self._window_thresholds(plans, attribute)
+
+        # Which profiles need each interval and the security report, so the
+        # fetch for a token only covers the profiles it is still alive for
+        self.interval_masks = {}
+        for bit, plan in plans:
+            for interval in plan.intervals:
+                self.interval_masks[interval] = self.interval_masks.get(
+                    interval, 0) | bit
+        self.security_mask = sum(bit for bit, plan in plans
+                                 if plan.requires_security)
+
+        self.token_checks = [(name, getattr(self, f'_check_{name}'))
+                             for name, _ in TOKEN_CHECKS]
+        self.enriched_checks = [(name, getattr(self, f'_check_{name}'))
+                                for name, _ in ENRICHED_CHECKS]
+        self.evaluations = 0
+        self.sample_every = min(token_filter.sample_every
+                                for token_filter in filters.values())
+
+    def token_mask(self, token):
+        passing, seconds = self._evaluate(self.token_checks, token)
+        mask = self.all
+        for passed in passing.values():
+            mask &= passed
+        self._count('token_checks', passing, seconds, self.all)
+        return mask
+
+    def intervals(self, mask):
+        return {
+            interval
+            for interval, needed in self.interval_masks.items()
+            if needed & mask
+        }
+
+    def requires_security(self, mask):
+        return bool(self.security_mask & mask)
+
+    def enriched_mask(self, token, ohlcv_data, security_data, mask):
+        # Checks on data that is None (endpoint unavailable) are skipped, as
+        # in TokenFilter
+        passing, seconds = self._evaluate(self.enriched_checks, token,
+                                          ohlcv_data, security_data)
+        self._count('enriched_checks', passing, seconds, mask)
+        for passed in passing.values():
+            if passed is not None:
+                mask &= passed
+        return mask
+
+    def _evaluate(self, checks, *data):
+        # Mask of the profiles each check lets through, and on sampled
+        # evaluations the seconds each check took for all of them
+        self.evaluations += 1
+        if self.evaluations % self.sample_every:
+            return {name: check(*data) for name, check in checks}, None
+        passing, seconds = {}, {}
+        for name, check in checks:
+            start = time.perf_counter()
+            passing[name] = check(*data)
+            seconds[name] = time.perf_counter() - start
+        return passing, seconds
+
+    def _count(self, stage, passing, seconds, alive):
+        # Each profile counts the outcome in its own plan's check order, so
+        # its filter's statistics and ordering work as if it ran alone
+        for i, key in enumerate(self.keys):
+            if alive >> i & 1:
+                token_filter = self.filters[key]
+                token_filter.count_checks(
+                    getattr(token_filter.plan, stage), passing, 1 << i,
+                    seconds)
+
+    def _check_liquidity(self, token):
+        return self.liquidity.passing(token.liquidity)
+
+    def _check_market_cap(self, token):
+        return (self.min_market_cap.passing(token.market_cap)
+                & self.max_market_cap.passing(token.market_cap))
+
+    def _check_first_mint_date(self, token):
+        return self.first_mint_time.passing(token.mint_time)
+
+    def _check_windows(self, field, ohlcv_data):
+        if ohlcv_data is None:
+            return None
+        mask = self.all
+        for period, thresholds in self.windows[field].items():
+            if period in ohlcv_data:
+                mask &= thresholds.passing(ohlcv_data[period][field])
+        return mask
+
+    def _check_volume(self, token, ohlcv_data, security_data):
+        return self._check_windows('valid_volume', ohlcv_data)
+
+    def _check_volume_usd(self, token, ohlcv_data, security_data):
+        return self._check_windows('volume_usd', ohlcv_data)
+
+    def _check_price_change(self, token, ohlcv_data, security_data):
+        return self._check_windows('price_change_percent', ohlcv_data)
+
+    def _check_creator_ownership(self, token, ohlcv_data, security_data):
+        if security_data is None:
+            return None
+        return self.creator_ownership.passing(security_data.creator_ownership)
+
+    def _check_token_security(self, token, ohlcv_data, security_data):
+        if security_data is None:
+            return None
+        if security_data.is_secure:
+            return self.all
+        return self.all & ~self.security_required
+
+    def _check_supply_traded(self, token, ohlcv_data, security_data):
+        if ohlcv_data is None:
+            return None
+        total_supply = token.total_supply
+        if total_supply == 0:
+            return 0
+        volume_24h = ohlcv_data['24h']['volume']
+        return self.supply_traded.passing((volume_24h / total_supply) * 100)
+
+    def profiles(self, mask):
+        return [key for i, key in enumerate(self.keys) if mask >> i & 1]
+
+    def _window_thresholds(self, plans, attribute):
+        periods = {}
+        for bit, plan in plans:
+            for period, threshold in getattr(plan, attribute):
+                periods.setdefault(period, []).append((threshold, bit))
+        return {
+            period:
+            _Thresholds(entries,
+                        free=self.all
+                        & ~sum(bit for _, bit in entries))
+            for period, entries in periods.items()
+        }
+
+
+class FilterProfiles:
+
+    # Filter criteria per chat. Chats that never changed a setting share the
+    # default profile (key None) built from config.yaml. Chat profiles are
+    # saved in the state store, if any, and restored on start.
+
+    def __init__(self, default_criteria, state_store=None):
+        self.filters = {None: TokenFilter(default_criteria)}
+        self.state_store = state_store
+        if state_store is not None:
+            for chat_id, criteria in state_store.load_profiles().items():
+                self.filters[chat_id] = TokenFilter(criteria)
+        self.subscribers = set()
+        # Called after every change to the profiles or subscribers
+        self.watchers = []
+        self._rebuild()
+
+    def criteria_for(self, chat_id):
+        key = chat_id if chat_id in self.filters else None
+        return copy.deepcopy(self.filters[key].criteria)
+
+    def publish(self, chat_id, criteria):
+        if chat_id in self.filters:
+            self.filters[chat_id].publish(criteria)
+        else:
+            self.filters[chat_id] = TokenFilter(criteria)
+        if self.state_store is not None and chat_id is not None:
+            self.state_store.save_profile(chat_id, criteria)
+        self._rebuild()
+
+    def set_subscribers(self, chat_ids):
+        self.subscribers = set(chat_ids)
+        self._rebuild()
+
+    def recipients(self, keys):
+        chats = set()
+        for key in keys:
+            if key is None:
+                chats.update(chat for chat in self.subscribers
+                             if chat not in self.filters)
+            elif key in self.subscribers:
+                chats.add(key)
+        return chats
+
+    def _rebuild(self):
+        # Only profiles with a subscriber are evaluated; the default profile
+        # is kept when nobody is subscribed so scans still report matches
+        active = [chat for chat in self.subscribers if chat in self.filters]
+        if not active or any(chat not in self.filters
+                             for chat in self.subscribers):
+            active.append(None)
+        self.index = ProfileIndex({key: self.filters[key] for key in active})
+        for watcher in self.watchers:
+            watcher()
@@ -0,0 +1,172 @@
+import aiohttp
+import asyncio
+import logging
+import random
+from collections import OrderedDict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Event type -> function returning the new token's address from its data
+LISTING_EVENTS = {
+    'TOKEN_NEW_LISTING_DATA': lambda data: data.get('address'),
+    'NEW_PAIR_DATA': lambda data: (data.get('base') or {}).get('address'),
+}
+
+
+class ListingStream:
+
+    # Push ingestion of new listings over Birdeye's WebSocket, one connection
+    # per chain. Every listing is handed to on_listing(chain, address) as
+    # soon as it arrives. Listings missed while disconnected are backfilled
+    # through the polling endpoint after each (re)connect, using the same
+    # per-chain cursor as polling.
+
+    def __init__(self,
+                 api,
+                 chains,
+                 on_listing,
+                 url='wss://public-api.birdeye.so/socket',
+                 subscriptions=('SUBSCRIBE_TOKEN_NEW_LISTING',
+                                'SUBSCRIBE_NEW_PAIR'),
+                 max_pending=100,
+                 heartbeat=30,
+                 reconnect_base=1,
+                 reconnect_max=60,
+                 recent_size=10000):
+        self.api = api
+        self.chains = chains
+        self.on_listing = on_listing
+        self.url = url
+        self.subscriptions = subscriptions
+        self.pending = asyncio.Semaphore(max_pending)
+        self.heartbeat = heartbeat
+        self.reconnect_base = reconnect_base
+        self.reconnect_max = reconnect_max
+        self.recent_size = recent_size
+        # Per chain, addresses handed over lately; a listing can arrive as
+        # both a listing and a pair event, or in a backfill and live
+        self.recent = {chain: OrderedDict() for chain in chains}
+        self.tasks = set()
+        # Per chain, evaluations not finished yet -> arrival time of their
+        # listing, None for backfilled ones. The shared cursor only moves
+        # past listings that have been evaluated.
+        self.unfinished = {chain: {} for chain in chains}
+        # Per chain, times up to which every listing has been received, live
+        # or through the last backfill
+        self.live_to = {}
+        self.backfilled_to = {}
+        self.connects = 0
+        self.backfilled = 0
+        self.received = 0
+
+    async def run(self):
+        try:
+            await asyncio.gather(*(self._run_chain(chain)
+                                   for chain in self.chains))
+        finally:
+            for task in self.tasks:
+                task.cancel()
+
+    async def _run_chain(self, chain):
+        attempt = 0
+        while True:
+            try:
+                await self._consume(chain)
+                attempt = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Listing stream for {chain} failed: {e}")
+            delay = min(self.reconnect_max, self.reconnect_base * 2**attempt)
+            attempt += 1
+            await asyncio.sleep(random.uniform(delay / 2, delay))
+
+    async def _consume(self, chain):
+        if self.api.session is None or self.api.session.closed:
+            await self.api.start()
+        async with self.api.session.ws_connect(
+                f"{self.url}/{chain}",
+                params={'x-api-key': self.api.api_key},
+                protocols=('echo-protocol', ),
+                heartbeat=self.heartbeat) as ws:
+            for subscription in self.subscriptions:
+                await ws.send_json({'type': subscription})
+            self.connects += 1
+            logger.info(f"Listing stream for {chain} connected")
+            # Subscribed first, so nothing falls between the backfill and
+            # the live events
+            await self._backfill(chain)
+            async for message in ws:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    if message.type == aiohttp.WSMsgType.ERROR:
+                        raise ws.exception()
+                    continue
+                self._handle(chain, message.json())
+                # While connected the stream is the source of truth, so a
+                # later backfill only has to cover the disconnect
+                self.live_to[chain] = datetime.now()
+                self._advance_cursor(chain)
+        logger.warning(f"Listing stream for {chain} closed")
+
+    async def _backfill(self, chain):
+        listings, fetched_to = await self.api.fetch_new_listings(chain)
+        for token in listings or []:
+            address = token.get('address') if isinstance(token,
+                                                         dict) else token
+            if isinstance(address, str) and self._submit(chain, address):
+                self.backfilled += 1
+        self.backfilled_to[chain] = fetched_to
+        self._advance_cursor(chain)
+
+    def _handle(self, chain, message):
+        address_of = LISTING_EVENTS.get(message.get('type'))
+        if address_of is None:
+            return
+        address = address_of(message.get('data') or {})
+        if isinstance(address, str) and self._submit(chain, address,
+                                                     datetime.now()):
+            self.received += 1
+
+    def _submit(self, chain, address, listed_at=None):
+        recent = self.recent[chain]
+        if address in recent:
+            return False
+        recent[address] = None
+        if len(recent) > self.recent_size:
+            recent.popitem(last=False)
+        task = asyncio.create_task(self._evaluate(chain, address))
+        self.tasks.add(task)
+        self.unfinished[chain][task] = listed_at
+        task.add_done_callback(self.tasks.discard)
+        task.add_done_callback(lambda task: self._finished(chain, task))
+        return True
+
+    def _finished(self, chain, task):
+        if task.cancelled():
+            return  # shutting down; the listing was not evaluated
+        del self.unfinished[chain][task]
+        self._advance_cursor(chain)
+
+    def _advance_cursor(self, chain):
+        # To the oldest listing still being evaluated, or to the time every
+        # listing has been received up to
+        unfinished = self.unfinished[chain].values()
+        if None in unfinished:
+            return  # the backfill is not evaluated yet
+        covered = [
+            time for time in (self.live_to.get(chain),
+                              self.backfilled_to.get(chain))
+            if time is not None
+        ]
+        cursor = min(unfinished, default=max(covered, default=None))
+        if cursor is not None:
+            self.api.advance_cursor(chain, cursor)
+
+    async def _evaluate(self, chain, address):
+        async with self.pending:
+            try:
+                await self.on_listing(chain, address)
+            except Exception as e:
+                logger.error(f"Failed to evaluate {chain} listing {address}: "
+                             f"{e}")
@@ -1,6 +1,13 @@
 import asyncio
 import yaml
 from birdeye_api import BirdeyeAPI
+from filter_profiles import FilterProfiles
+from listing_stream import ListingStream
+from metrics import Metrics
+from recording import ResponseRecorder
+from scheduler import ChainScheduler
+from sharding import AlertSink, LocalWorkers
+from state_store import StateStore
 from token_scanner import TokenScanner
 from telegram_bot import TelegramBot
 import logging
@@ -12,6 +19,61 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def format_alert(token):
+    return (f"New token alert:\n"
+            f"Symbol: {token.symbol}\n"
+            f"Chain: {token.chain or 'N/A'}\n"
+            f"Address: {token.address or 'N/A'}\n"
+            f"Market Cap: ${token.market_cap:,.2f}\n"
+            f"24h Volume: ${token.volume_24h:,.2f}\n"
+            f"24h Price Change: {token.price_change_24h:g}%\n"
+            f"Liquidity: ${token.liquidity:,.2f}\n"
+            f"Total Supply: {token.total_supply:,.0f}\n"
+            f"Creator Ownership: {token.creator_ownership:g}%")
+
+
+def format_stats(api, scheduler, scanner, dispatcher):
+    api_stats = api.stats()
+    lines = [
+        f"Birdeye: {api_stats['requests']} requests, "
+        f"{api_stats['coalesced']} coalesced, {api_stats['hedges']} hedged, "
+        f"{api_stats['in_flight']} in flight"
+    ]
+    for endpoint, latency in api.latencies.items():
+        p50, p95 = latency.percentile(0.5), latency.percentile(0.95)
+        timing = (f"p50 {p50:.2f}s, p95 {p95:.2f}s"
+                  if p50 is not None else "too few calls")
+        state = api_stats['breakers'].get(endpoint, 'closed')
+        lines.append(f"  {endpoint}: {timing}, circuit {state}")
+    lines.append("Scans:")
+    for chain, chain_stats in scheduler.stats().items():
+        duration = chain_stats['last_duration']
+        took = f"{duration:.1f}s" if duration is not None else "-"
+        lines.append(f"  {chain}: every {chain_stats['interval']:.0f}s, "
+                     f"last took {took}, {chain_stats['skipped']} skipped")
+    lines.append(f"Alerts: {dispatcher.depth()} queued, {dispatcher.sent} "
+                 f"sent, {dispatcher.dropped} dropped")
+    lines.append("Rejections:")
+    index = scanner.profiles.index
+    for key in index.keys:
+        counts = index.filters[key].check_counts()
+        rejections = ", ".join(f"{check} {rejected}"
+                               for check, (_, rejected, _) in counts.items()
+                               if rejected)
+        profile = 'default' if key is None else f"chat {key}"
+        lines.append(f"  {profile}: {rejections or 'none'}")
+    return "\n".join(lines)
+
+
+def format_sink_stats(sink, dispatcher):
+    stats = sink.stats()
+    return (f"Workers connected: {stats['workers']}\n"
+            f"Matches: {stats['received']} received, "
+            f"{stats['duplicates']} duplicates\n"
+            f"Alerts: {dispatcher.depth()} queued, {dispatcher.sent} sent, "
+            f"{dispatcher.dropped} dropped")
+
+
 async def main():
     try:
         # Load configuration
@@ -24,11 +86,71 @@ async def main():
         ]
 
         # Initialize components
-        api = BirdeyeAPI(config['birdeye_api_key'])
-        scanner = TokenScanner(api, config['filter_criteria'],
-                               config['scan_new_listings_only'])
-        bot = TelegramBot(config['telegram_bot_token'], allowed_chat_ids,
-                          config['filter_criteria'])
+        metric_settings = config.get('metrics', {})
+        metrics = Metrics(metric_settings.get('enabled', False))
+        state_settings = config.get('state', {})
+        state_store = StateStore(
+            state_settings.get('path', 'state.db'),
+            state_settings.get('snapshot_ttl', 24 * 3600),
+            state_settings.get('alert_ttl', 30 * 24 * 3600))
+        state_store.open()
+
+        shard_settings = config.get('sharding', {})
+        if shard_settings.get('enabled', False):
+            # Worker processes scan; this one dedups their matches and owns
+            # the bot and the per-chat profiles, which it sends to them
+            profiles = FilterProfiles(config['filter_criteria'], state_store)
+            bot = TelegramBot(config['telegram_bot_token'],
+                              allowed_chat_ids, profiles,
+                              config.get('alerts', {}), state_store, metrics,
+                              lambda: format_sink_stats(sink, bot.dispatcher))
+            bot.setup()
+            await bot.run()
+            sink = AlertSink(
+                shard_settings.get('sink',
+                                   '/tmp/tradingo-alerts.sock'), profiles,
+                lambda chain, address, token, profile_keys: bot.enqueue_alert(
+                    format_alert(token), profiles.recipients(profile_keys),
+                    (chain, address)), shard_settings.get('dedup_ttl', 300))
+            await sink.start()
+            await metrics.serve(metric_settings.get('host', '127.0.0.1'),
+                                metric_settings.get('port', 9108))
+            workers = LocalWorkers(config)
+            workers.start()
+            logger.info("Bot started successfully")
+            await workers.supervise()
+
+        recording = config.get('recording', {})
+        recorder = None
+        if recording.get('enabled', False):
+            recorder = ResponseRecorder(
+                recording.get('path', 'responses.jsonl.gz'),
+                recording.get('flush_every', 100))
+            recorder.open()
+        api = BirdeyeAPI(config['birdeye_api_key'], config.get('http', {}),
+                         config.get('rate_limit', {}), config.get('cache', {}),
+                         state_store,
+                         state_settings.get('max_backfill_minutes', 60),
+                         config.get('resilience', {}), recorder, metrics)
+        await api.start()
+        scanner = TokenScanner(api,
+                               config['filter_criteria'],
+                               config['scan_new_listings_only'],
+                               config.get('max_concurrent_requests', 20),
+                               config.get('ohlcv_base_interval', '1m'),
+                               config.get('candle_store_max_tokens', 5000),
+                               state_store,
+                               config.get('seen_tokens', {}),
+                               config.get('all_tokens_page_size', 500),
+                               metrics,
+                               candle_store_max_bytes=config.get(
+                                   'candle_store_max_bytes', 64 * 1024 * 1024))
+        bot = TelegramBot(
+            config['telegram_bot_token'], allowed_chat_ids, scanner.profiles,
+            config.get('alerts', {}), state_store, metrics,
+            lambda: format_stats(api, scheduler, scanner, bot.dispatcher))
+        await metrics.serve(metric_settings.get('host', '127.0.0.1'),
+                            metric_settings.get('port', 9108))
 
         # Setup and start the bot
         bot.setup()
@@ -36,44 +158,64 @@ async def main():
 
         logger.info("Bot started successfully")
 
-        # Start scanning
-        while True:
-            try:
-                matching_tokens = await scanner.scan_tokens(config['chains'])
-                for token in matching_tokens:
-                    alert_message = (
-                        f"New token alert:\n"
-                        f"Symbol: {token.get('symbol', 'N/A')}\n"
-                        f"Chain: {token.get('chain', 'N/A')}\n"
-                        f"Address: {token.get('address', 'N/A')}\n"
-                        f"Market Cap: ${token.get('marketCap', 0):,.2f}\n"
-                        f"24h Volume: ${token.get('volume', {}).get('h24', 0):,.2f}\n"
-                        f"24h Price Change: {token.get('priceChange', {}).get('h24', 0)}%\n"
-                        f"Liquidity: ${token.get('liquidity', 0):,.2f}\n"
-                        f"Total Supply: {token.get('totalSupply', 0):,.0f}\n"
-                        f"Creator Ownership: {token.get('creatorOwnership', 0)}%"
-                    )
-                    for chat_id in bot.subscribed_users:
-                        await bot.send_alert(chat_id, alert_message)
-
-                logger.info(
-                    f"Scanned and found {len(matching_tokens)} matching tokens"
-                )
-
-            except Exception as e:
-                logger.error(f"An error occurred during scanning: {e}",
-                             exc_info=True)
-
-            # Wait for the next scan interval
-            await asyncio.sleep(config['scan_interval'])
+        async def scan_chain(chain):
+            found = 0
+            # Alerts go out while the chain is still being scanned
+            matches = scanner.stream_tokens([chain],
+                                            config.get('max_pending_matches',
+                                                       100))
+            async for _, address, token, profile_keys in matches:
+                found += 1
+                bot.enqueue_alert(format_alert(token),
+                                  scanner.profiles.recipients(profile_keys),
+                                  (chain, address))
+            logger.info(f"Scanned {chain} and found {found} matching tokens")
+            return scanner.listing_counts.pop(chain, None)
+
+        async def alert_listing(chain, address):
+            match = await scanner.evaluate_listing(chain, address)
+            if match is not None:
+                address, token, profile_keys = match
+                bot.enqueue_alert(format_alert(token),
+                                  scanner.profiles.recipients(profile_keys),
+                                  (chain, address))
+
+        # Start scanning; every chain runs on its own timer
+        scheduler = ChainScheduler(scan_chain,
+                                   config['chains'],
+                                   config['scan_interval'],
+                                   api.rate_limiter,
+                                   **config.get('scheduler', {}),
+                                   metrics=metrics)
+        stream_settings = dict(config.get('listing_stream', {}))
+        if stream_settings.pop('enabled', False):
+            # New listings are pushed as they happen; the scans still run to
+            # retry deferred tokens and catch anything the stream missed
+            stream = ListingStream(api, config['chains'], alert_listing,
+                                   **stream_settings)
+            await asyncio.gather(scheduler.run(), stream.run())
+        else:
+            await scheduler.run()
 
     except Exception as e:
         logger.critical(f"A critical error occurred: {e}", exc_info=True)
 
     finally:
         # Ensure the bot is properly shut down
+        if 'workers' in locals():
+            workers.stop()
+        if 'sink' in locals():
+            await sink.close()
         if 'bot' in locals():
             await bot.stop()
+        if 'api' in locals():
+            await api.close()
+        if 'state_store' in locals():
+            state_store.close()
+        if 'recorder' in locals() and recorder is not None:
+            recorder.close()
+        if 'metrics' in locals():
+            await metrics.close()
         logger.info("Bot shut down")
 
 
@@ -0,0 +1,210 @@
+import logging
+from bisect import bisect_left
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds; a final +Inf bucket is implied
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+                   60)
+
+
+class _NullMetric:
+
+    # Stands in for every metric while metrics are disabled
+
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+NULL_METRIC = _NullMetric()
+
+
+class _Value:
+
+    __slots__ = ('value', )
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _Buckets:
+
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class _Metric:
+
+    def __init__(self, kind, name, help_text, label_names, make):
+        self.kind = kind
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.make = make
+        self.children = {}  # label values -> _Value or _Buckets
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.make()
+        return child
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self, lines):
+        for values, child in self.children.items():
+            labels = dict(zip(self.label_names, values))
+            if self.kind != 'histogram':
+                lines.append(_sample(self.name, labels, child.value))
+                continue
+            total = 0
+            for bound, count in zip(child.bounds, child.counts):
+                total += count
+                lines.append(
+                    _sample(f"{self.name}_bucket", {
+                        **labels, 'le': f"{bound:g}"
+                    }, total))
+            total += child.counts[-1]
+            lines.append(
+                _sample(f"{self.name}_bucket", {
+                    **labels, 'le': '+Inf'
+                }, total))
+            lines.append(_sample(f"{self.name}_sum", labels, child.sum))
+            lines.append(_sample(f"{self.name}_count", labels, total))
+
+
+class Metrics:
+
+    # Counters, gauges and histograms served in the Prometheus text format.
+    # Components create their metrics up front and update them in place;
+    # values that already live in a component (queue sizes, filter counters)
+    # are read by collectors at scrape time instead. Disabled, every metric
+    # is NULL_METRIC and collectors are never registered.
+
+    def __init__(self, enabled=False, prefix='tradingo'):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.metrics = {}
+        self.collectors = []
+        self.runner = None
+
+    def counter(self, name, help_text, labels=()):
+        return self._metric('counter', name, help_text, labels, _Value)
+
+    def gauge(self, name, help_text, labels=()):
+        return self._metric('gauge', name, help_text, labels, _Value)
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._metric('histogram', name, help_text, labels,
+                            lambda: _Buckets(buckets))
+
+    def collect(self, collector):
+        # collector() yields (kind, name, help, [(labels dict, value)])
+        if self.enabled:
+            self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            _header(lines, metric.kind, metric.name, metric.help_text)
+            metric.render(lines)
+        for collector in self.collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+                continue
+            for kind, name, help_text, samples in families:
+                name = f"{self.prefix}_{name}"
+                _header(lines, kind, name, help_text)
+                for labels, value in samples:
+                    lines.append(_sample(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host='127.0.0.1', port=9108):
+        if not self.enabled or self.runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def _handle(self, request):
+        return web.Response(text=self.render(),
+                            content_type='text/plain',
+                            charset='utf-8')
+
+    def _metric(self, kind, name, help_text, labels, make):
+        if not self.enabled:
+            return NULL_METRIC
+        name = f"{self.prefix}_{name}"
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = _Metric(kind, name, help_text,
+                                                  tuple(labels), make)
+        return metric
+
+
+DISABLED = Metrics()
+
+
+def _header(lines, kind, name, help_text):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+
+
+def _sample(name, labels, value):
+    if labels:
+        pairs = ",".join(f'{key}="{_escape(label)}"'
+                         for key, label in labels.items())
+        return f"{name}{{{pairs}}} {_number(value)}"
+    return f"{name} {_number(value)}"
+
+
+def _number(value):
+    if isinstance(value, int):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(label):
+    label = str(label).replace('\\', '\\\\').replace('"', '\\"')
+    return label.replace('\n', '\\n')
@@ -0,0 +1,94 @@
+import re
+from bisect import bisect_left
+from records import CandleSeries
+
+INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def interval_seconds(interval):
+    match = re.fullmatch(r'(\d+)([smhdw])', interval.strip().lower())
+    if not match:
+        raise ValueError(f"Invalid OHLCV interval: {interval}")
+    return int(match.group(1)) * INTERVAL_UNITS[match.group(2)]
+
+
+def window_end(now, base_seconds):
+    # End of the candle that is currently forming
+    return (int(now) // base_seconds + 1) * base_seconds
+
+
+def parse_candles(data):
+    # Accepts Birdeye's short keys (o/c/v) as well as spelled-out ones
+    items = data.get('items', []) if isinstance(data, dict) else data
+    rows = []
+    for item in items or []:
+        open_price = float(item.get('o', item.get('open', 0)) or 0)
+        close_price = float(item.get('c', item.get('close', 0)) or 0)
+        volume = float(item.get('v', item.get('volume', 0)) or 0)
+        volume_usd = item.get('volume_usd', item.get('vUsd'))
+        if volume_usd is None:
+            volume_usd = volume * close_price
+        price_change_percent = item.get('price_change_percent')
+        if price_change_percent is None:
+            price_change_percent = percent_change(open_price, close_price)
+        rows.append((int(item.get('unixTime',
+                                  0)), open_price, close_price, volume,
+                     float(volume_usd), float(price_change_percent)))
+    rows.sort(key=lambda row: row[0])
+    candles = CandleSeries()
+    for row in rows:
+        candles.append(*row)
+    return candles
+
+
+def calculate_valid_volume(candles, start=0, stop=None):
+    # Volume of candles that moved the price, ignoring the first candle
+    stop = len(candles) if stop is None else stop
+    valid_volume = 0
+    volumes, changes = candles.volumes, candles.changes
+    for i in range(start + 1, stop):
+        if changes[i] != 0:
+            valid_volume += volumes[i]
+    return valid_volume
+
+
+def summarize(candles, start=0, stop=None):
+    # Summary of candles[start:stop]
+    stop = len(candles) if stop is None else stop
+    if start >= stop:
+        return {
+            'volume': 0,
+            'volume_usd': 0,
+            'price_change_percent': 0,
+            'valid_volume': 0
+        }
+    return {
+        'volume':
+        sum(candles.volumes[start:stop]),
+        'volume_usd':
+        sum(candles.volumes_usd[start:stop]),
+        'price_change_percent':
+        percent_change(candles.opens[start], candles.closes[stop - 1]),
+        'valid_volume':
+        calculate_valid_volume(candles, start, stop)
+    }
+
+
+def build_windows(candles, intervals, end):
+    # Slices one base-resolution series into the trailing window of every
+    # interval. These are not the candles a fetch at that interval returns:
+    # valid_volume counts the base candles of [end - interval, end) that
+    # moved the price, leaving out the window's first one, where it used to
+    # count the interval's own candles.
+    stop = bisect_left(candles.times, end)
+    windows = {}
+    for interval in intervals:
+        start = bisect_left(candles.times, end - interval_seconds(interval))
+        windows[interval] = summarize(candles, start, stop)
+    return windows
+
+
+def percent_change(start, end):
+    if not start:
+        return 0.0
+    return (end - start) / start * 100
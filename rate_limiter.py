@@ -0,0 +1,88 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst=None, min_rate=None):
+        self.target_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = float(min_rate or max(rate / 10, 0.1))
+        self.capacity = float(burst or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.granted = 0  # tokens handed out so far, for usage estimates
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._wakeup = None
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        if not self._waiters and self._try_take():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._schedule()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The token was granted just before the caller gave up
+                self.tokens = min(self.capacity, self.tokens + 1)
+                self.granted -= 1
+            raise
+
+    def throttle(self, seconds, factor=0.5):
+        # Hold every caller back for the Retry-After of a 429 so the remaining
+        # quota is not spent on requests that would be rejected. Rejections
+        # arriving during the same pause only count once against the rate.
+        now = time.monotonic()
+        if now >= self.paused_until:
+            self.rate = max(self.min_rate, self.rate * factor)
+        self.paused_until = max(self.paused_until, now + seconds)
+
+    def reward(self, step=0.05):
+        if self.rate < self.target_rate:
+            self.rate = min(self.target_rate,
+                            self.rate + self.target_rate * step)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def _try_take(self):
+        now = self._refill()
+        if now < self.paused_until or self.tokens < 1:
+            return False
+        self.tokens -= 1
+        self.granted += 1
+        return True
+
+    def _release_waiters(self):
+        self._wakeup = None
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():
+                heapq.heappop(self._waiters)  # cancelled while waiting
+                continue
+            if not self._try_take():
+                break
+            heapq.heappop(self._waiters)
+            future.set_result(None)
+        self._schedule()
+
+    def _schedule(self):
+        if self._wakeup is not None or not self._waiters:
+            return
+        now = self._refill()
+        delay = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0)
+        self._wakeup = asyncio.get_running_loop().call_later(
+            delay, self._release_waiters)
@@ -0,0 +1,63 @@
+import gzip
+import json
+import logging
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseRecorder:
+
+    # Appends every Birdeye response to a gzip-compressed JSON lines log:
+    # {"t": unix time, "path": ..., "params": {...}, "data": {...}}. Each run
+    # appends a new gzip member, which reads back as one stream. The log is
+    # flushed every flush_every responses, so a crash loses at most those.
+
+    def __init__(self, path='responses.jsonl.gz', flush_every=100):
+        self.path = path
+        self.flush_every = flush_every
+        self.file = None
+        self.pending = 0
+        self.recorded = 0
+
+    def open(self):
+        self.file = gzip.open(self.path, 'at', encoding='utf-8')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def record(self, path, params, data):
+        if self.file is None:
+            return
+        self.file.write(
+            json.dumps(
+                {
+                    't': time.time(),
+                    'path': path,
+                    'params': params or {},
+                    'data': data
+                },
+                separators=(',', ':')) + '\n')
+        self.recorded += 1
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.file.flush()
+            self.pending = 0
+
+
+def read_log(path):
+    # Yields (t, path, params, data) in recorded order. A log cut short by a
+    # crash is read up to its last complete response.
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        try:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                yield entry['t'], entry['path'], entry['params'], entry['data']
+        except (EOFError, zlib.error) as e:
+            logger.warning(f"Response log {path} ends early: {e}")
@@ -0,0 +1,129 @@
+import json
+from array import array
+from datetime import datetime, timedelta, timezone
+
+try:
+    import orjson
+except ImportError:  # in requirements.txt; decoding falls back to json
+    orjson = None
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def loads(body):
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def epoch_micros(value):
+    # Naive dates are taken as UTC so they compare with aware ones
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return (moment - EPOCH) // timedelta(microseconds=1)
+
+
+def _number(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class TokenRecord:
+
+    # The token fields the filter and alerts read, parsed once from a
+    # Birdeye token payload; the rest of the payload is not kept
+
+    __slots__ = ('chain', 'address', 'symbol', 'price', 'liquidity',
+                 'market_cap', 'total_supply', 'mint_time', 'volume_24h',
+                 'price_change_24h', 'creator_ownership')
+
+    def __init__(self,
+                 chain=None,
+                 address=None,
+                 symbol='N/A',
+                 price=0.0,
+                 liquidity=0.0,
+                 market_cap=0.0,
+                 total_supply=0.0,
+                 mint_time=0,
+                 volume_24h=0.0,
+                 price_change_24h=0.0,
+                 creator_ownership=0.0):
+        self.chain = chain
+        self.address = address
+        self.symbol = symbol
+        self.price = price
+        self.liquidity = liquidity
+        self.market_cap = market_cap
+        self.total_supply = total_supply
+        self.mint_time = mint_time  # epoch microseconds
+        self.volume_24h = volume_24h
+        self.price_change_24h = price_change_24h
+        self.creator_ownership = creator_ownership
+
+    @classmethod
+    def from_dict(cls, data, chain=None, address=None):
+        data = data if isinstance(data, dict) else {}
+        mint_date = data.get('mintDate') or '1970-01-01T00:00:00Z'
+        try:
+            mint_time = epoch_micros(mint_date)
+        except (AttributeError, TypeError, ValueError):
+            mint_time = 0
+        return cls(
+            data.get('chain') or chain,
+            data.get('address') or address, data.get('symbol', 'N/A'),
+            _number(data.get('price')), _number(data.get('liquidity')),
+            _number(data.get('marketCap')), _number(data.get('totalSupply')),
+            mint_time, _number((data.get('volume') or {}).get('h24')),
+            _number((data.get('priceChange') or {}).get('h24')),
+            _number(data.get('creatorOwnership')))
+
+
+class SecurityReport:
+
+    # Defaults match a missing report: unknown ownership counts as 100%
+
+    __slots__ = ('creator_ownership', 'is_secure')
+
+    def __init__(self, creator_ownership=100.0, is_secure=False):
+        self.creator_ownership = creator_ownership
+        self.is_secure = is_secure
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data if isinstance(data, dict) else {}
+        creator_ownership = data.get('creator_ownership')
+        return cls(
+            100.0 if creator_ownership is None else _number(creator_ownership),
+            bool(data.get('is_secure', False)))
+
+
+class CandleSeries:
+
+    # Candles sorted by open time, one array per field
+
+    __slots__ = ('times', 'opens', 'closes', 'volumes', 'volumes_usd',
+                 'changes')
+
+    def __init__(self):
+        self.times = array('q')
+        self.opens = array('d')
+        self.closes = array('d')
+        self.volumes = array('d')
+        self.volumes_usd = array('d')
+        self.changes = array('d')  # price change percent per candle
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, unix_time, open_price, close_price, volume, volume_usd,
+               change):
+        self.times.append(unix_time)
+        self.opens.append(open_price)
+        self.closes.append(close_price)
+        self.volumes.append(volume)
+        self.volumes_usd.append(volume_usd)
+        self.changes.append(change)
@@ -0,0 +1,108 @@
+import time
+from collections import deque
+
+
+class CircuitOpenError(Exception):
+
+    def __init__(self, endpoint, retry_in):
+        super().__init__(f"Circuit for {endpoint} is open, "
+                         f"retrying in {retry_in:.0f}s")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class LatencyTracker:
+
+    # Rolling latency percentiles over the last `window` successful calls.
+    # The sorted copy is only rebuilt every `refresh` samples.
+
+    def __init__(self, window=200, min_samples=20, refresh=10):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.refresh = refresh
+        self.sorted = []
+        self.stale = 0
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.stale += 1
+
+    def percentile(self, fraction):
+        if len(self.samples) < self.min_samples:
+            return None
+        if self.stale >= self.refresh or not self.sorted:
+            self.sorted = sorted(self.samples)
+            self.stale = 0
+        index = min(int(fraction * len(self.sorted)), len(self.sorted) - 1)
+        return self.sorted[index]
+
+
+class HedgeBudget:
+
+    # Every call earns `ratio` of a hedge, up to `burst` saved up, so hedges
+    # stay a bounded share of the traffic even when latency degrades
+
+    def __init__(self, ratio=0.05, burst=5):
+        self.ratio = ratio
+        self.burst = burst
+        self.credits = burst
+
+    def earn(self):
+        self.credits = min(self.burst, self.credits + self.ratio)
+
+    def take(self):
+        if self.credits < 1:
+            return False
+        self.credits -= 1
+        return True
+
+
+class CircuitBreaker:
+
+    # Opens after `failure_threshold` consecutive failures and then fails
+    # calls fast for `reset_timeout` seconds. After that a single trial call
+    # is let through: success closes the circuit, failure opens it again.
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, endpoint, failure_threshold=5, reset_timeout=30):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.rejected = 0
+
+    def check(self):
+        # Raises CircuitOpenError when the call may not go out
+        if self.state == self.CLOSED:
+            return
+        retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+        if self.state == self.OPEN and retry_in <= 0:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self.trial_running:
+            self.trial_running = True
+            return
+        self.rejected += 1
+        raise CircuitOpenError(self.endpoint, max(retry_in, 0))
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        if (self.state == self.HALF_OPEN
+                or self.failures >= self.failure_threshold):
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+        self.trial_running = False
+
+    def release(self):
+        # A trial call that ended without a verdict (e.g. cancelled)
+        self.trial_running = False
@@ -0,0 +1,72 @@
+import sys
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+
+    def __init__(self, ttls, max_entries=50000, max_bytes=64 * 1024 * 1024):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expires_at, size, value)
+        self.size = 0
+        self.hits = {}
+        self.misses = {}
+        self.evictions = 0
+
+    def enabled(self, endpoint):
+        return self.ttls.get(endpoint, 0) > 0
+
+    def get(self, endpoint, key):
+        key = (endpoint, key)
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits[endpoint] = self.hits.get(endpoint, 0) + 1
+                return entry[2]
+            self._remove(key)
+        self.misses[endpoint] = self.misses.get(endpoint, 0) + 1
+        return None
+
+    def put(self, endpoint, key, value, age=0):
+        key = (endpoint, key)
+        if key in self.entries:
+            self._remove(key)
+        size = _estimate_size(value)
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttls[endpoint] - age
+        self.entries[key] = (expires_at, size, value)
+        self.size += size
+        while (len(self.entries) > self.max_entries
+               or self.size > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': dict(self.hits),
+            'misses': dict(self.misses),
+            'evictions': self.evictions
+        }
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)[1]
+
+
+def _estimate_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += _estimate_size(key) + _estimate_size(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += _estimate_size(item)
+    elif hasattr(value, '__slots__'):
+        for name in value.__slots__:
+            size += _estimate_size(getattr(value, name))
+    return size
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import math
+from metrics import DISABLED
+
+logger = logging.getLogger(__name__)
+
+
+class _ChainState:
+
+    __slots__ = ('chain', 'base_interval', 'interval', 'runs', 'skipped',
+                 'last_started', 'last_duration', 'listing_rate')
+
+    def __init__(self, chain, interval):
+        self.chain = chain
+        self.base_interval = interval
+        self.interval = interval
+        self.runs = 0
+        self.skipped = 0  # ticks that passed while a scan was still running
+        self.last_started = None
+        self.last_duration = None
+        self.listing_rate = None  # smoothed new listings per second
+
+
+class ChainScheduler:
+
+    # Runs scan(chain) for every chain on its own fixed-rate timer. Ticks are
+    # anchored to the first one, so the scan time does not add to the period,
+    # and a chain is never scanned twice at once: ticks that pass while its
+    # scan is still running are skipped and counted.
+    #
+    # With adaptive on, a busy chain's interval shrinks with its new-listing
+    # rate so that a scan finds about target_listings listings (scan returns
+    # the number of listings it fetched, or None when that is not a rate).
+    # A quiet chain keeps its base interval: only a short API budget
+    # stretches intervals past it.
+
+    def __init__(self,
+                 scan,
+                 chains,
+                 interval,
+                 rate_limiter=None,
+                 intervals=None,
+                 adaptive=False,
+                 min_interval=10,
+                 max_interval=600,
+                 target_listings=5,
+                 budget_utilization=0.8,
+                 smoothing=0.3,
+                 metrics=None):
+        self.scan = scan
+        intervals = intervals or {}
+        self.chains = {
+            chain: _ChainState(chain, intervals.get(chain, interval))
+            for chain in chains
+        }
+        self.rate_limiter = rate_limiter
+        self.adaptive = adaptive
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_listings = target_listings
+        self.budget_utilization = budget_utilization
+        self.smoothing = smoothing
+        self.utilization = 0.0
+        self.budget_checked = None
+        self.budget_granted = 0
+        metrics = metrics or DISABLED
+        self.scan_seconds = metrics.histogram('scan_seconds',
+                                              'Scan cycle duration per chain',
+                                              ('chain', ))
+        metrics.collect(self._collect_metrics)
+
+    async def run(self):
+        # Chains start spread over the shortest interval rather than all
+        # hitting the API at once
+        spread = min(state.interval for state in self.chains.values())
+        offset = spread / max(len(self.chains), 1)
+        tasks = [
+            asyncio.create_task(self._run_chain(state, i * offset))
+            for i, state in enumerate(self.chains.values())
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            chain: {
+                'interval': state.interval,
+                'runs': state.runs,
+                'skipped': state.skipped,
+                'last_duration': state.last_duration,
+                'listing_rate': state.listing_rate
+            }
+            for chain, state in self.chains.items()
+        }
+
+    def _collect_metrics(self):
+        states = self.chains.values()
+        yield ('gauge', 'scan_interval_seconds',
+               'Current scan interval per chain',
+               [(dict(chain=state.chain), state.interval) for state in states])
+        yield ('counter', 'scan_skipped_ticks_total',
+               'Ticks skipped while the previous scan was still running', [
+                   (dict(chain=state.chain), state.skipped) for state in states
+               ])
+
+    async def _run_chain(self, state, delay):
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(delay)
+        next_tick = loop.time()
+        while True:
+            started = loop.time()
+            try:
+                listings = await self.scan(state.chain)
+            except Exception as e:
+                logger.error(f"Scan of {state.chain} failed: {e}",
+                             exc_info=True)
+                listings = None
+            finished = loop.time()
+            state.runs += 1
+            state.last_duration = finished - started
+            self.scan_seconds.labels(state.chain).observe(state.last_duration)
+            state.interval = self._next_interval(state, listings, started)
+            state.last_started = started
+
+            next_tick += state.interval
+            if finished > next_tick:
+                missed = math.ceil((finished - next_tick) / state.interval)
+                state.skipped += missed
+                next_tick += missed * state.interval
+                logger.warning(f"Scan of {state.chain} took "
+                               f"{state.last_duration:.1f}s, skipped {missed} "
+                               f"tick(s)")
+            await asyncio.sleep(next_tick - finished)
+
+    def _next_interval(self, state, listings, started):
+        if not self.adaptive:
+            return state.base_interval
+        interval = state.base_interval
+        if listings is not None and state.last_started is not None:
+            rate = listings / max(started - state.last_started, 1e-3)
+            if state.listing_rate is None:
+                state.listing_rate = rate
+            else:
+                state.listing_rate += self.smoothing * (rate -
+                                                        state.listing_rate)
+        if state.listing_rate:
+            # Shortened no further than min_interval, never lengthened
+            interval = min(
+                interval,
+                max(self.target_listings / state.listing_rate,
+                    self.min_interval))
+        interval *= self._budget_factor(started)
+        return min(interval, max(self.max_interval, state.base_interval))
+
+    def _budget_factor(self, now):
+        # Above 1 while the limiter runs slower than its target after 429s,
+        # or while the requests granted use more than budget_utilization of
+        # the target rate
+        limiter = self.rate_limiter
+        if limiter is None:
+            return 1.0
+        if self.budget_checked is None:
+            self.budget_checked = now
+            self.budget_granted = limiter.granted
+        elif now - self.budget_checked >= 1:
+            used = limiter.granted - self.budget_granted
+            self.utilization = (used / (now - self.budget_checked) /
+                                limiter.target_rate)
+            self.budget_checked = now
+            self.budget_granted = limiter.granted
+        return max(1.0, limiter.target_rate / limiter.rate,
+                   self.utilization / self.budget_utilization)
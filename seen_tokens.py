@@ -0,0 +1,114 @@
+import math
+import time
+from array import array
+
+# Token fields that decide whether a token needs to be enriched again. The
+# 24h volume and price change stand in for the OHLCV windows, so a volume
+# surge at a flat price is not skipped.
+FINGERPRINT_FIELDS = ('price', 'liquidity', 'market_cap', 'total_supply',
+                      'mint_time', 'volume_24h', 'price_change_24h')
+
+HASH_MASK = (1 << 64) - 1
+EXPIRY_MASK = (1 << 32) - 1
+
+
+class SeenTokens:
+
+    # Tokens enriched recently, with a fingerprint of their market fields.
+    # Entries are a 64-bit hash of (chain, address) and a 64-bit word packing
+    # a 32-bit fingerprint with a 32-bit expiry, in two open-addressing
+    # tables of fixed size. When the current table fills up it replaces the
+    # previous one, so the tokens not enriched for a whole generation are
+    # forgotten and memory never grows past max_bytes.
+
+    def __init__(self,
+                 max_bytes=64 * 1024 * 1024,
+                 ttl=300,
+                 tolerance=0.01,
+                 clock=time.monotonic):
+        # Two tables of 16 bytes per slot, sized to a power of two
+        slots = 1 << max(4, (max_bytes // 32).bit_length() - 1)
+        self.mask = slots - 1
+        self.limit = slots * 3 // 4
+        self.ttl = ttl
+        self.tolerance = tolerance
+        # Seconds the TTL is measured in; replays substitute recorded time
+        self.clock = clock
+        self.current = self._table()
+        self.previous = self._table()
+        self.count = 0
+        self.rotations = 0
+
+    def __len__(self):
+        return self.count
+
+    def fingerprint(self, token):
+        # Numbers are bucketed on a log scale, so moves smaller than the
+        # tolerance usually keep the fingerprint
+        step = math.log1p(self.tolerance)
+        parts = []
+        for field in FINGERPRINT_FIELDS:
+            value = getattr(token, field)
+            if isinstance(value, float) and value:
+                value = math.copysign(round(math.log(abs(value)) / step),
+                                      value)
+            parts.append(value)
+        return hash(tuple(parts)) & EXPIRY_MASK
+
+    def unchanged(self, chain, address, fingerprint):
+        key = _key(chain, address)
+        value = self._lookup(self.current, key)
+        if value is None:
+            value = self._lookup(self.previous, key)
+        if value is None:
+            return False
+        return (value >> 32 == fingerprint
+                and value & EXPIRY_MASK > self.clock())
+
+    def remember(self, chain, address, fingerprint):
+        key = _key(chain, address)
+        value = fingerprint << 32 | int(self.clock() + self.ttl)
+        if self._insert(self.current, key, value):
+            self.count += 1
+            if self.count >= self.limit:
+                self.previous = self.current
+                self.current = self._table()
+                self.count = 0
+                self.rotations += 1
+
+    def clear(self):
+        self.current = self._table()
+        self.previous = self._table()
+        self.count = 0
+
+    def _table(self):
+        size = 8 * (self.mask + 1)
+        return array('Q', bytes(size)), array('Q', bytes(size))
+
+    def _lookup(self, table, key):
+        keys, values = table
+        slot = key & self.mask
+        while keys[slot]:
+            if keys[slot] == key:
+                return values[slot]
+            slot = (slot + 1) & self.mask
+        return None
+
+    def _insert(self, table, key, value):
+        # Returns whether the key is new to the table
+        keys, values = table
+        slot = key & self.mask
+        while keys[slot]:
+            if keys[slot] == key:
+                values[slot] = value
+                return False
+            slot = (slot + 1) & self.mask
+        keys[slot] = key
+        values[slot] = value
+        return True
+
+
+def _key(chain, address):
+    # 0 marks an empty slot. Two addresses only share an entry on a 64-bit
+    # hash collision, which at worst skips one token until its TTL runs out.
+    return hash((chain, address)) & HASH_MASK or 1
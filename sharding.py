@@ -0,0 +1,405 @@
+# Scanning split across worker processes, on this host or others. Workers
+# own whole chains in new-listings mode and all_tokens pages otherwise, by
+# consistent hashing of their names, and send their matches to one alert
+# sink in the coordinating process, which owns the Telegram bot. Workers on
+# other hosts are started with the same config.yaml:
+#   python sharding.py <node name>
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+import yaml
+from birdeye_api import BirdeyeAPI
+from records import TokenRecord
+from scheduler import ChainScheduler
+from state_store import StateStore
+from token_scanner import TokenScanner
+
+logger = logging.getLogger(__name__)
+
+# Longest line a connection accepts; profile updates carry every profile
+MAX_MESSAGE_BYTES = 4 * 1024 * 1024
+
+
+def stable_hash(key):
+    # The same in every process, unlike hash()
+    return int.from_bytes(
+        hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+def node_names(settings):
+    local = [f'worker-{i}' for i in range(settings.get('workers', 2))]
+    return local + list(settings.get('remote_nodes', []))
+
+
+class HashRing:
+
+    # Each node has `replicas` points on a 64-bit ring; a key belongs to the
+    # node of the first point after its hash. Adding or removing a node only
+    # moves the keys next to its points.
+
+    def __init__(self, nodes, replicas=64):
+        points = sorted((stable_hash(f'{node}#{i}'), node) for node in nodes
+                        for i in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        index = bisect_right(self.hashes, stable_hash(key))
+        return self.nodes[index % len(self.nodes)]
+
+    def fraction(self, node):
+        # Part of the ring whose keys belong to node: the arcs up to each of
+        # its points from the point before
+        owned = sum((point - self.hashes[i - 1]) % 2**64
+                    for i, point in enumerate(self.hashes)
+                    if self.nodes[i] == node)
+        return owned / 2**64
+
+
+class Shard:
+
+    # The part of the scanning one worker node owns
+
+    def __init__(self, node, nodes, replicas=64):
+        if node not in nodes:
+            raise ValueError(f"Unknown node {node}, expected one of {nodes}")
+        self.node = node
+        self.ring = HashRing(nodes, replicas)
+
+    def owns_chain(self, chain):
+        return self.ring.node_for(chain) == self.node
+
+    def owns_page(self, chain, page):
+        return self.ring.node_for(f'{chain}/{page}') == self.node
+
+    def share(self, chains=None):
+        # Part of the scanning this node owns: its chains out of chains, or
+        # else the all_tokens pages expected to hash to it
+        if chains is not None:
+            return sum(map(self.owns_chain, chains)) / max(1, len(chains))
+        return self.ring.fraction(self.node)
+
+
+async def _open(address):
+    # address is a Unix socket path or host:port
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return await asyncio.open_connection(host,
+                                             int(port),
+                                             limit=MAX_MESSAGE_BYTES)
+    return await asyncio.open_unix_connection(address, limit=MAX_MESSAGE_BYTES)
+
+
+async def _listen(address, handle):
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return await asyncio.start_server(handle,
+                                          host,
+                                          int(port),
+                                          limit=MAX_MESSAGE_BYTES)
+    if os.path.exists(address):
+        os.unlink(address)  # left over from a previous run
+    return await asyncio.start_unix_server(handle,
+                                           address,
+                                           limit=MAX_MESSAGE_BYTES)
+
+
+def _line(message):
+    return (json.dumps(message, separators=(',', ':')) + '\n').encode()
+
+
+class AlertSink:
+
+    # Receives the matches of every worker and hands each (chain, address)
+    # to on_match(chain, address, token, profile_keys) once per dedup_ttl:
+    # after a page boundary shifts, two workers can scan the same token.
+    # Workers get the filter profiles on connect and after every change.
+
+    def __init__(self,
+                 address,
+                 profiles,
+                 on_match,
+                 dedup_ttl=300,
+                 max_recent=100000):
+        self.address = address
+        self.profiles = profiles
+        self.on_match = on_match
+        self.dedup_ttl = dedup_ttl
+        self.max_recent = max_recent
+        self.recent = OrderedDict()  # (chain, address) -> expiry, oldest first
+        self.writers = set()
+        self.handlers = set()
+        self.server = None
+        self.received = 0
+        self.duplicates = 0
+        profiles.watchers.append(self._broadcast)
+
+    async def start(self):
+        self.server = await _listen(self.address, self._handle)
+        logger.info(f"Alert sink listening on {self.address}")
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            # Closing a connection ends its handler's read loop
+            for writer in self.writers:
+                writer.close()
+            await asyncio.gather(*self.handlers, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+
+    def stats(self):
+        return {
+            'workers': len(self.writers),
+            'received': self.received,
+            'duplicates': self.duplicates
+        }
+
+    async def _handle(self, reader, writer):
+        handler = asyncio.current_task()
+        self.handlers.add(handler)
+        self.writers.add(writer)
+        writer.write(self._profiles_message())
+        try:
+            async for line in reader:
+                message = json.loads(line)
+                if message.get('type') == 'match':
+                    self._match(message)
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Worker connection failed: {e}")
+        finally:
+            self.handlers.discard(handler)
+            self.writers.discard(writer)
+            writer.close()
+
+    def _match(self, message):
+        self.received += 1
+        key = (message['chain'], message['address'])
+        now = time.monotonic()
+        recent = self.recent
+        while recent and next(iter(recent.values())) <= now:
+            recent.popitem(last=False)
+        if key in recent:
+            self.duplicates += 1
+            return
+        recent[key] = now + self.dedup_ttl
+        if len(recent) > self.max_recent:
+            recent.popitem(last=False)
+        self.on_match(message['chain'], message['address'],
+                      TokenRecord(**message['token']), message['keys'])
+
+    def _profiles_message(self):
+        return _line({
+            'type':
+            'profiles',
+            'profiles':
+            [[key, token_filter.criteria]
+             for key, token_filter in self.profiles.filters.items()],
+            'subscribers':
+            list(self.profiles.subscribers)
+        })
+
+    def _broadcast(self):
+        message = self._profiles_message()
+        for writer in self.writers:
+            writer.write(message)
+
+
+class AlertClient:
+
+    # A worker's connection to the alert sink, reconnected when it drops.
+    # Matches found while disconnected are dropped; the next scan finds
+    # them again.
+
+    def __init__(self, address, profiles, reconnect_max=30):
+        self.address = address
+        self.profiles = profiles
+        self.reconnect_max = reconnect_max
+        self.writer = None
+        self.connected = asyncio.Event()
+        self.dropped = 0
+
+    async def run(self):
+        attempt = 0
+        while True:
+            try:
+                reader, self.writer = await _open(self.address)
+                attempt = 0
+                self.connected.set()
+                async for line in reader:
+                    message = json.loads(line)
+                    if message.get('type') == 'profiles':
+                        self._apply_profiles(message)
+            except (ConnectionError, FileNotFoundError, ValueError) as e:
+                logger.warning(f"Alert sink connection failed: {e}")
+            finally:
+                self.connected.clear()
+                if self.writer is not None:
+                    self.writer.close()
+                    self.writer = None
+            await asyncio.sleep(min(self.reconnect_max, 2**attempt))
+            attempt += 1
+
+    async def send(self, chain, address, token, keys):
+        if self.writer is None:
+            self.dropped += 1
+            return
+        self.writer.write(
+            _line({
+                'type': 'match',
+                'chain': chain,
+                'address': address,
+                'token': {
+                    name: getattr(token, name)
+                    for name in TokenRecord.__slots__
+                },
+                'keys': list(keys)
+            }))
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            self.dropped += 1
+
+    def _apply_profiles(self, message):
+        for key, criteria in message['profiles']:
+            current = self.profiles.filters.get(key)
+            if current is None or current.criteria != criteria:
+                self.profiles.publish(key, criteria)
+        self.profiles.set_subscribers(message['subscribers'])
+
+
+async def run_worker(config, node):
+    settings = config.get('sharding', {})
+    shard = Shard(node, node_names(settings), settings.get('replicas', 64))
+    new_listings_only = config['scan_new_listings_only']
+    chains = config['chains']
+    if new_listings_only:
+        share = shard.share(chains)
+        chains = [chain for chain in chains if shard.owns_chain(chain)]
+    else:
+        share = shard.share()
+    if not chains:
+        # No share of the API budget; the process stays up so it is not
+        # restarted over and over
+        logger.info(f"{node} owns no chains")
+        await asyncio.Event().wait()
+
+    # Each node gets the share of the API budget of the work it owns
+    rate_limit = dict(config.get('rate_limit', {}))
+    rate_limit['requests_per_second'] = (
+        rate_limit.get('requests_per_second', 15) * share)
+    rate_limit['burst'] = max(1, int(rate_limit.get('burst', 15) * share))
+    state_settings = config.get('state', {})
+    stem, suffix = os.path.splitext(state_settings.get('path', 'state.db'))
+    state_store = StateStore(f'{stem}.{node}{suffix}',
+                             state_settings.get('snapshot_ttl', 24 * 3600))
+    state_store.open()
+    api = BirdeyeAPI(config['birdeye_api_key'], config.get('http', {}),
+                     rate_limit, config.get('cache', {}), state_store,
+                     state_settings.get('max_backfill_minutes', 60),
+                     config.get('resilience', {}))
+    scanner = TokenScanner(
+        api, config['filter_criteria'], new_listings_only,
+        math.ceil(config.get('max_concurrent_requests', 20) * share),
+        config.get('ohlcv_base_interval', '1m'),
+        config.get('candle_store_max_tokens', 5000), None,
+        config.get('seen_tokens', {}), config.get('all_tokens_page_size', 500),
+        None, None if new_listings_only else shard,
+        config.get('candle_store_max_bytes', 64 * 1024 * 1024))
+    client = AlertClient(settings.get('sink', '/tmp/tradingo-alerts.sock'),
+                         scanner.profiles)
+    connection = asyncio.create_task(client.run())
+
+    async def scan_chain(chain):
+        found = 0
+        async for _, address, token, keys in scanner.stream_tokens(
+            [chain], config.get('max_pending_matches', 100)):
+            found += 1
+            await client.send(chain, address, token, keys)
+        logger.info(f"{node} scanned {chain} and found {found} matching "
+                    f"tokens")
+        return scanner.listing_counts.pop(chain, None)
+
+    try:
+        await api.start()
+        # Scan with the coordinator's profiles, not just the default one
+        await client.connected.wait()
+        scheduler = ChainScheduler(scan_chain, chains, config['scan_interval'],
+                                   api.rate_limiter,
+                                   **config.get('scheduler', {}))
+        await scheduler.run()
+    finally:
+        connection.cancel()
+        await api.close()
+        state_store.close()
+
+
+def _worker_process(config, node):
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    try:
+        asyncio.run(run_worker(config, node))
+    except KeyboardInterrupt:
+        pass
+
+
+class LocalWorkers:
+
+    # The worker processes of this host, restarted if they die
+
+    def __init__(self, config, check_interval=5):
+        self.config = config
+        self.check_interval = check_interval
+        settings = config.get('sharding', {})
+        self.nodes = node_names(settings)[:settings.get('workers', 2)]
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = {}
+
+    def start(self):
+        for node in self.nodes:
+            self._spawn(node)
+
+    async def supervise(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            for node, process in list(self.processes.items()):
+                if not process.is_alive():
+                    logger.warning(f"Worker {node} exited with "
+                                   f"{process.exitcode}, restarting")
+                    self._spawn(node)
+
+    def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(5)
+        self.processes = {}
+
+    def _spawn(self, node):
+        process = self.context.Process(target=_worker_process,
+                                       args=(self.config, node),
+                                       name=node,
+                                       daemon=True)
+        process.start()
+        self.processes[node] = process
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.exit("Usage: python sharding.py <node name>")
+    with open('config.yaml', 'r') as file:
+        config = yaml.safe_load(file)
+    _worker_process(config, sys.argv[1])
+
+
+if __name__ == "__main__":
+    main()
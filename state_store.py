@@ -0,0 +1,157 @@
+import json
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scan_cursors (
+    chain TEXT PRIMARY KEY,
+    scanned_to TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    chain TEXT NOT NULL,
+    address TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (chain, address, kind)
+);
+CREATE INDEX IF NOT EXISTS snapshots_updated_at ON snapshots (updated_at);
+CREATE TABLE IF NOT EXISTS alerts (
+    chain TEXT NOT NULL,
+    address TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    sent_at REAL NOT NULL,
+    PRIMARY KEY (chain, address, chat_id)
+);
+CREATE INDEX IF NOT EXISTS alerts_sent_at ON alerts (sent_at);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    chat_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS profiles (
+    chat_id INTEGER PRIMARY KEY,
+    criteria TEXT NOT NULL
+);
+"""
+
+
+class StateStore:
+
+    # Embedded SQLite store for state that should survive restarts. Rows are
+    # read on demand, so startup only opens the file. Snapshots older than
+    # snapshot_ttl and alerts older than alert_ttl seconds are pruned at
+    # most every prune_interval seconds, as new rows are written; an alert
+    # pruned that way can be sent again.
+
+    def __init__(self,
+                 path='state.db',
+                 snapshot_ttl=24 * 3600,
+                 alert_ttl=30 * 24 * 3600,
+                 prune_interval=3600):
+        self.path = path
+        self.snapshot_ttl = snapshot_ttl
+        self.alert_ttl = alert_ttl
+        self.prune_interval = prune_interval
+        self.pruned_at = 0.0
+        self.connection = None
+
+    def open(self):
+        if self.connection is not None:
+            return
+        self.connection = sqlite3.connect(self.path, isolation_level=None)
+        # WAL keeps reads from blocking on writes; NORMAL sync only fsyncs at
+        # checkpoints, which is enough for state that can be rebuilt
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.prune()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def get_cursor(self, chain):
+        row = self.connection.execute(
+            "SELECT scanned_to FROM scan_cursors WHERE chain = ?",
+            (chain, )).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, chain, scanned_to):
+        self.connection.execute(
+            "INSERT INTO scan_cursors (chain, scanned_to) VALUES (?, ?) "
+            "ON CONFLICT (chain) DO UPDATE SET scanned_to = excluded.scanned_to",
+            (chain, scanned_to))
+
+    def get_snapshot(self, chain, address, kind, max_age=None):
+        # Returns (data, age in seconds), or None if missing or too old
+        row = self.connection.execute(
+            "SELECT data, updated_at FROM snapshots "
+            "WHERE chain = ? AND address = ? AND kind = ?",
+            (chain, address, kind)).fetchone()
+        if row is None:
+            return None
+        age = time.time() - row[1]
+        if max_age is not None and age > max_age:
+            return None
+        return json.loads(row[0]), age
+
+    def save_snapshot(self, chain, address, kind, data):
+        self.connection.execute(
+            "INSERT INTO snapshots (chain, address, kind, data, updated_at) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (chain, address, kind) "
+            "DO UPDATE SET data = excluded.data, "
+            "updated_at = excluded.updated_at",
+            (chain, address, kind, json.dumps(data), time.time()))
+        self._maybe_prune()
+
+    def was_alerted(self, chain, address, chat_id):
+        return self.connection.execute(
+            "SELECT 1 FROM alerts "
+            "WHERE chain = ? AND address = ? AND chat_id = ?",
+            (chain, address, chat_id)).fetchone() is not None
+
+    def record_alert(self, chain, address, chat_id):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO alerts (chain, address, chat_id, sent_at) "
+            "VALUES (?, ?, ?, ?)", (chain, address, chat_id, time.time()))
+        self._maybe_prune()
+
+    def prune(self):
+        now = time.time()
+        self.connection.execute("DELETE FROM snapshots WHERE updated_at < ?",
+                                (now - self.snapshot_ttl, ))
+        self.connection.execute("DELETE FROM alerts WHERE sent_at < ?",
+                                (now - self.alert_ttl, ))
+        self.pruned_at = now
+
+    def _maybe_prune(self):
+        if time.time() - self.pruned_at >= self.prune_interval:
+            self.prune()
+
+    def load_subscriptions(self):
+        return {
+            row[0]
+            for row in self.connection.execute(
+                "SELECT chat_id FROM subscriptions")
+        }
+
+    def add_subscription(self, chat_id):
+        self.connection.execute(
+            "INSERT OR IGNORE INTO subscriptions (chat_id) VALUES (?)",
+            (chat_id, ))
+
+    def remove_subscription(self, chat_id):
+        self.connection.execute("DELETE FROM subscriptions WHERE chat_id = ?",
+                                (chat_id, ))
+
+    def load_profiles(self):
+        return {
+            row[0]: json.loads(row[1])
+            for row in self.connection.execute(
+                "SELECT chat_id, criteria FROM profiles")
+        }
+
+    def save_profile(self, chat_id, criteria):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO profiles (chat_id, criteria) VALUES (?, ?)",
+            (chat_id, json.dumps(criteria)))
@@ -1,16 +1,214 @@
+from telegram.error import NetworkError, RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
+import asyncio
+import logging
+import time
 import yaml
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timedelta
+from metrics import DISABLED
+from ohlcv import interval_seconds
+from rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+class AlertDispatcher:
+
+    def __init__(self,
+                 bot,
+                 queue_size=1000,
+                 global_messages_per_second=30,
+                 chat_messages_per_second=1,
+                 digest_threshold=3,
+                 max_pending_per_chat=100,
+                 max_send_attempts=3,
+                 metrics=None,
+                 on_done=None):
+        self.bot = bot
+        self.queue = asyncio.Queue(queue_size)
+        self.global_bucket = TokenBucket(global_messages_per_second)
+        self.chat_messages_per_second = chat_messages_per_second
+        self.digest_threshold = digest_threshold
+        self.max_pending_per_chat = max_pending_per_chat
+        self.max_send_attempts = max_send_attempts
+        self.pending = {}  # chat_id -> deque of (alert text, token key)
+        # on_done(chat_id, token keys, sent) is called once alerts have been
+        # sent or dropped
+        self.on_done = on_done
+        self.chat_buckets = {}
+        self.senders = {}  # chat_id -> task draining that chat
+        self.dropped = 0
+        self.sent = 0
+        self.task = None
+        metrics = metrics or DISABLED
+        self.send_seconds = metrics.histogram('alert_send_seconds',
+                                              'Telegram send_message latency')
+        metrics.collect(self._collect_metrics)
+
+    def submit(self, chat_id, message, token_key=None):
+        # Never waits: the scan loop hands alerts off and moves on
+        try:
+            self.queue.put_nowait((chat_id, message, token_key))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"Alert queue full, dropped alert for {chat_id}")
+            return False
+
+    def depth(self):
+        # Alerts accepted but not sent yet
+        return self.queue.qsize() + sum(
+            len(pending) for pending in self.pending.values())
+
+    def _collect_metrics(self):
+        yield ('gauge', 'alert_queue_depth', 'Alerts waiting to be sent',
+               [({}, self.depth())])
+        yield ('counter', 'alerts_sent_total', 'Messages sent to chats',
+               [({}, self.sent)])
+        yield ('counter', 'alerts_dropped_total',
+               'Alerts dropped on a full queue or after failed sends', [
+                   ({}, self.dropped)
+               ])
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = [self.task, *self.senders.values()] if self.task else []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.task = None
+        self.senders = {}
+
+    async def _run(self):
+        while True:
+            chat_id, message, token_key = await self.queue.get()
+            pending = self.pending.get(chat_id)
+            if pending is None:
+                pending = self.pending[chat_id] = deque(
+                    maxlen=self.max_pending_per_chat)
+            if len(pending) == pending.maxlen:
+                self.dropped += 1
+                self._done(chat_id, [pending[0][1]], False)
+            pending.append((message, token_key))
+            if chat_id not in self.senders:
+                self.senders[chat_id] = asyncio.create_task(
+                    self._drain_chat(chat_id))
+
+    async def _drain_chat(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(
+                self.chat_messages_per_second, 1)
+        pending = self.pending[chat_id]
+        try:
+            while pending:
+                await bucket.acquire()
+                text, token_keys = self._next_message(pending)
+                await self.global_bucket.acquire()
+                sent = await self._send(chat_id, text)
+                if not sent:
+                    self.dropped += len(token_keys)
+                self._done(chat_id, token_keys, sent)
+        finally:
+            del self.senders[chat_id]
+            if not pending:
+                del self.pending[chat_id]
+
+    def _next_message(self, pending):
+        # Returns the text to send and the token keys it covers. A chat that
+        # has fallen behind gets its backlog as one digest.
+        if len(pending) < self.digest_threshold:
+            message, token_key = pending.popleft()
+            return message, [token_key]
+        total = len(pending)
+        parts = []
+        token_keys = []
+        # Leave room for the header line
+        length = 64
+        while (pending
+               and length + len(pending[0][0]) + 2 <= MAX_MESSAGE_LENGTH):
+            message, token_key = pending.popleft()
+            parts.append(message)
+            token_keys.append(token_key)
+            length += len(message) + 2
+        if not parts:
+            message, token_key = pending.popleft()
+            return message[:MAX_MESSAGE_LENGTH], [token_key]
+        if len(parts) < total:
+            header = f"{len(parts)} of {total} new token alerts:"
+        else:
+            header = f"{total} new token alerts:"
+        return "\n\n".join([header] + parts), token_keys
+
+    def _done(self, chat_id, token_keys, sent):
+        if self.on_done is not None:
+            self.on_done(chat_id, token_keys, sent)
+
+    async def _send(self, chat_id, text):
+        for attempt in range(self.max_send_attempts):
+            try:
+                started = time.perf_counter()
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                self.send_seconds.observe(time.perf_counter() - started)
+                self.sent += 1
+                return True
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                # Flood control applies to the whole bot, so hold every chat
+                self.global_bucket.throttle(retry_after, factor=1)
+                await self.global_bucket.acquire()
+            except NetworkError as e:
+                # Includes TimedOut; the message may go through on a retry
+                logger.warning(f"Sending alert to {chat_id} failed: {e}")
+                if attempt + 1 < self.max_send_attempts:
+                    await asyncio.sleep(2**attempt)
+            except TelegramError as e:
+                logger.error(f"Failed to send alert to {chat_id}: {e}")
+                return False
+        logger.error(f"Gave up sending alert to {chat_id} after "
+                     f"{self.max_send_attempts} attempts")
+        return False
 
 
 class TelegramBot:
 
-    def __init__(self, token, allowed_chat_ids, filter_criteria):
+    def __init__(self,
+                 token,
+                 allowed_chat_ids,
+                 profiles,
+                 alert_settings=None,
+                 state_store=None,
+                 metrics=None,
+                 stats=None):
         self.application = Application.builder().token(token).build()
         self.allowed_chat_ids = set(
             int(chat_id) for chat_id in allowed_chat_ids)
-        self.filter_criteria = filter_criteria
+        # Per-chat filter criteria; settings commands only change the
+        # profile of the chat they are sent from
+        self.profiles = profiles
+        # Subscriptions and the alert history survive restarts when a state
+        # store is given
+        self.state_store = state_store
         self.subscribed_users = set()
+        if state_store is not None:
+            self.subscribed_users = state_store.load_subscriptions()
+            self.profiles.set_subscribers(self.subscribed_users)
+        # (chain, address, chat_id) of the alerts queued but not sent yet
+        self.queued = set()
+        self.dispatcher = AlertDispatcher(self.application.bot,
+                                          **(alert_settings or {}),
+                                          metrics=metrics,
+                                          on_done=self._alerts_done)
+        # Returns the text of the /stats reply
+        self.stats = stats
 
     def setup(self):
         self.application.add_handler(CommandHandler("start", self.start))
@@ -47,15 +245,47 @@ class TelegramBot:
         self.application.add_handler(
             CommandHandler("unsubscribe", self.unsubscribe))
         self.application.add_handler(CommandHandler("status", self.status))
+        self.application.add_handler(
+            CommandHandler("stats", self.stats_command))
 
     async def run(self):
         await self.application.initialize()
         await self.application.start()
         await self.application.updater.start_polling()
+        self.dispatcher.start()
 
     async def stop(self):
+        await self.dispatcher.stop()
         await self.application.stop()
 
+    def enqueue_alert(self, message, chat_ids=None, token_key=None):
+        # token_key is (chain, address); a chat is alerted about a token once
+        if chat_ids is None:
+            chat_ids = self.subscribed_users
+        dedup = token_key is not None and self.state_store is not None
+        for chat_id in chat_ids:
+            if (chat_id not in self.allowed_chat_ids
+                    or chat_id not in self.subscribed_users):
+                continue
+            if not dedup:
+                self.dispatcher.submit(chat_id, message)
+                continue
+            alert = (*token_key, chat_id)
+            if alert in self.queued or self.state_store.was_alerted(*alert):
+                continue
+            if self.dispatcher.submit(chat_id, message, token_key):
+                self.queued.add(alert)
+
+    def _alerts_done(self, chat_id, token_keys, sent):
+        # An alert counts as sent once Telegram accepted it; dropped ones
+        # can be alerted again
+        for token_key in token_keys:
+            if token_key is None:
+                continue
+            self.queued.discard((*token_key, chat_id))
+            if sent:
+                self.state_store.record_alert(*token_key, chat_id)
+
     async def send_alert(self, chat_id, message):
         if int(chat_id) in self.allowed_chat_ids and int(
                 chat_id) in self.subscribed_users:
@@ -98,18 +328,20 @@ class TelegramBot:
 
     async def scan_new_listings(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
+            criteria = self.profiles.criteria_for(update.effective_chat.id)
             if len(context.args) != 1 or context.args[0] not in ['on', 'off']:
                 await update.message.reply_text(
                     "Usage: /scan_new_listings [on/off]")
                 return
-            self.filter_criteria['scan_new_listings_only'] = context.args[
-                0] == 'on'
+            criteria['scan_new_listings_only'] = context.args[0] == 'on'
+            self.profiles.publish(update.effective_chat.id, criteria)
             await update.message.reply_text(
                 f"Scan new listings only: {'On' if context.args[0] == 'on' else 'Off'}"
             )
 
     async def chain_selection(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
+            criteria = self.profiles.criteria_for(update.effective_chat.id)
             if len(context.args) < 1 or context.args[0] not in [
                     'all', 'specific'
             ]:
@@ -117,18 +349,20 @@ class TelegramBot:
                     "Usage: /chain_selection [all/specific] [chain_name]")
                 return
             if context.args[0] == 'all':
-                self.filter_criteria['chains'] = ['all']
+                criteria['chains'] = ['all']
             else:
                 if len(context.args) != 2:
                     await update.message.reply_text(
                         "Please specify a chain name for specific selection.")
                     return
-                self.filter_criteria['chains'] = [context.args[1]]
+                criteria['chains'] = [context.args[1]]
+            self.profiles.publish(update.effective_chat.id, criteria)
             await update.message.reply_text(
-                f"Chain selection updated: {self.filter_criteria['chains']}")
+                f"Chain selection updated: {criteria['chains']}")
 
     async def min_volume(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
+            criteria = self.profiles.criteria_for(update.effective_chat.id)
             if len(context.args) != 2:
                 await update.message.reply_text(
                     "Usage: /min_volume [time_period] [value]")
@@ -136,22 +370,27 @@ class TelegramBot:
             time_period, value = context.args
             try:
                 value = float(value)
-                self.filter_criteria['min_volume'][time_period] = value
+                interval_seconds(time_period)
+                criteria['min_volume'][time_period] = value
+                self.profiles.publish(update.effective_chat.id, criteria)
                 await update.message.reply_text(
                     f"Minimum volume for {time_period} set to {value}")
             except ValueError:
                 await update.message.reply_text(
-                    "Invalid value. Please enter a number.")
+                    "Invalid value. Please enter a number and a time period like 5m, 1h or 24h."
+                )
 
     async def min_liquidity(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
+            criteria = self.profiles.criteria_for(update.effective_chat.id)
             if len(context.args) != 1:
                 await update.message.reply_text("Usage: /min_liquidity [value]"
                                                 )
                 return
             try:
                 value = float(context.args[0])
-                self.filter_criteria['min_liquidity'] = value
+                criteria['min_liquidity'] = value
+                self.profiles.publish(update.effective_chat.id, criteria)
                 await update.message.reply_text(
                     f"Minimum liquidity set to {value}")
             except ValueError:
@@ -160,12 +399,14 @@ class TelegramBot:
 
     async def max_supply(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
+            criteria = self.profiles.criteria_for(update.effective_chat.id)
             if len(context.args) != 1:
                 await update.message.reply_text("Usage: /max_supply [value]")
                 return
             try:
                 value = float(context.args[0])
-                self.filter_criteria['max_supply'] = value
+                criteria['max_supply'] = value
+                self.profiles.publish(update.effective_chat.id, criteria)
                 await update.message.reply_text(
                     f"Maximum supply set to {value}")
             except ValueError:
@@ -174,13 +415,15 @@ class TelegramBot:
 
     async def min_market_cap(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
+            criteria = self.profiles.criteria_for(update.effective_chat.id)
             if len(context.args) != 1:
                 await update.message.reply_text(
                     "Usage: /min_market_cap [value]")
                 return
             try:
                 value = float(context.args[0])
-                self.filter_criteria['min_market_cap'] = value
+                criteria['min_market_cap'] = value
+                self.profiles.publish(update.effective_chat.id, criteria)
                 await update.message.reply_text(
                     f"Minimum market cap set to {value}")
             except ValueError:
@@ -189,13 +432,15 @@ class TelegramBot:
 
     async def max_market_cap(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
+            criteria = self.profiles.criteria_for(update.effective_chat.id)
             if len(context.args) != 1:
                 await update.message.reply_text(
                     "Usage: /max_market_cap [value]")
                 return
             try:
                 value = float(context.args[0])
-                self.filter_criteria['max_market_cap'] = value
+                criteria['max_market_cap'] = value
+                self.profiles.publish(update.effective_chat.id, criteria)
                 await update.message.reply_text(
                     f"Maximum market cap set to {value}")
             except ValueError:
@@ -204,6 +449,7 @@ class TelegramBot:
 
     async def min_price_change(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
+            criteria = self.profiles.criteria_for(update.effective_chat.id)
             if len(context.args) != 2:
                 await update.message.reply_text(
                     "Usage: /min_price_change [percentage] [time_period]")
@@ -211,17 +457,20 @@ class TelegramBot:
             percentage, time_period = context.args
             try:
                 percentage = float(percentage)
-                self.filter_criteria['min_price_change'][
-                    time_period] = percentage
+                interval_seconds(time_period)
+                criteria['min_price_change'][time_period] = percentage
+                self.profiles.publish(update.effective_chat.id, criteria)
                 await update.message.reply_text(
                     f"Minimum price change for {time_period} set to {percentage}%"
                 )
             except ValueError:
                 await update.message.reply_text(
-                    "Invalid value. Please enter a number for percentage.")
+                    "Invalid value. Please enter a number for percentage and a time period like 5m, 1h or 24h."
+                )
 
     async def min_volume_usd(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
+            criteria = self.profiles.criteria_for(update.effective_chat.id)
             if len(context.args) != 2:
                 await update.message.reply_text(
                     "Usage: /min_volume_usd [value] [time_period]")
@@ -229,33 +478,40 @@ class TelegramBot:
             value, time_period = context.args
             try:
                 value = float(value)
-                self.filter_criteria['min_volume_usd'][time_period] = value
+                interval_seconds(time_period)
+                criteria['min_volume_usd'][time_period] = value
+                self.profiles.publish(update.effective_chat.id, criteria)
                 await update.message.reply_text(
                     f"Minimum USD volume for {time_period} set to ${value}")
             except ValueError:
                 await update.message.reply_text(
-                    "Invalid value. Please enter a number.")
+                    "Invalid value. Please enter a number and a time period like 5m, 1h or 24h."
+                )
 
     async def token_security(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
+            criteria = self.profiles.criteria_for(update.effective_chat.id)
             if len(context.args) != 1 or context.args[0] not in ['on', 'off']:
                 await update.message.reply_text(
                     "Usage: /token_security [on/off]")
                 return
-            self.filter_criteria['token_security'] = context.args[0] == 'on'
+            criteria['token_security'] = context.args[0] == 'on'
+            self.profiles.publish(update.effective_chat.id, criteria)
             await update.message.reply_text(
                 f"Token security checks: {'On' if context.args[0] == 'on' else 'Off'}"
             )
 
     async def creator_threshold(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
+            criteria = self.profiles.criteria_for(update.effective_chat.id)
             if len(context.args) != 1:
                 await update.message.reply_text(
                     "Usage: /creator_threshold [percentage]")
                 return
             try:
                 value = float(context.args[0])
-                self.filter_criteria['max_creator_ownership'] = value
+                criteria['max_creator_ownership'] = value
+                self.profiles.publish(update.effective_chat.id, criteria)
                 await update.message.reply_text(
                     f"Creator ownership threshold set to {value}%")
             except ValueError:
@@ -264,13 +520,15 @@ class TelegramBot:
 
     async def first_mint_date(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
+            criteria = self.profiles.criteria_for(update.effective_chat.id)
             if len(context.args) != 1:
                 await update.message.reply_text(
                     "Usage: /first_mint_date [YYYY-MM-DD]")
                 return
             try:
                 date = datetime.strptime(context.args[0], "%Y-%m-%d")
-                self.filter_criteria['first_mint_date'] = date.isoformat()
+                criteria['first_mint_date'] = date.isoformat()
+                self.profiles.publish(update.effective_chat.id, criteria)
                 await update.message.reply_text(
                     f"First mint date set to {context.args[0]}")
             except ValueError:
@@ -279,13 +537,15 @@ class TelegramBot:
 
     async def supply_traded_percentage(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
+            criteria = self.profiles.criteria_for(update.effective_chat.id)
             if len(context.args) != 1:
                 await update.message.reply_text(
                     "Usage: /supply_traded_percentage [percentage]")
                 return
             try:
                 value = float(context.args[0])
-                self.filter_criteria['min_supply_traded'] = value
+                criteria['min_supply_traded'] = value
+                self.profiles.publish(update.effective_chat.id, criteria)
                 await update.message.reply_text(
                     f"Minimum supply traded percentage set to {value}%")
             except ValueError:
@@ -295,19 +555,33 @@ class TelegramBot:
     async def subscribe(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
             self.subscribed_users.add(update.effective_chat.id)
+            self.profiles.set_subscribers(self.subscribed_users)
+            if self.state_store is not None:
+                self.state_store.add_subscription(update.effective_chat.id)
             await update.message.reply_text(
                 "You have subscribed to real-time updates.")
 
     async def unsubscribe(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
             self.subscribed_users.discard(update.effective_chat.id)
+            self.profiles.set_subscribers(self.subscribed_users)
+            if self.state_store is not None:
+                self.state_store.remove_subscription(update.effective_chat.id)
             await update.message.reply_text(
                 "You have unsubscribed from real-time updates.")
 
     async def status(self, update, context):
         if update.effective_chat.id in self.allowed_chat_ids:
+            criteria = self.profiles.criteria_for(update.effective_chat.id)
             status_text = "Current settings:\n"
-            for key, value in self.filter_criteria.items():
+            for key, value in criteria.items():
                 status_text += f"{key}: {value}\n"
             status_text += f"Subscribed to updates: {'Yes' if update.effective_chat.id in self.subscribed_users else 'No'}"
             await update.message.reply_text(status_text)
+
+    async def stats_command(self, update, context):
+        if update.effective_chat.id in self.allowed_chat_ids:
+            if self.stats is None:
+                await update.message.reply_text("No statistics available.")
+                return
+            await update.message.reply_text(self.stats()[:MAX_MESSAGE_LENGTH])
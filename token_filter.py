@@ -1,85 +1,361 @@
-from datetime import datetime
+import copy
+import time
+from ohlcv import interval_seconds
+from records import epoch_micros
 
+# Each check and the data it reads, in evaluation order
+CHECKS = [
+    ('volume', ('token', 'ohlcv')),
+    ('volume_usd', ('ohlcv', )),
+    ('liquidity', ('token', )),
+    ('market_cap', ('token', )),
+    ('price_change', ('ohlcv', )),
+    ('creator_ownership', ('security', )),
+    ('supply_traded', ('token', 'ohlcv')),
+    ('token_security', ('security', )),
+    ('first_mint_date', ('token', )),
+]
+# Checks that can run on token data alone, before OHLCV/security are fetched
+TOKEN_CHECKS = [check for check in CHECKS if check[1] == ('token', )]
+ENRICHED_CHECKS = [check for check in CHECKS if check[1] != ('token', )]
+CHECK_NAMES = [name for name, _ in CHECKS]
 
-class TokenFilter:
 
-    def __init__(self, criteria):
+class FilterPlan:
+
+    # Immutable, pre-parsed snapshot of one version of the filter criteria.
+    # Checks that cannot reject anything are left out of the plan.
+
+    __slots__ = ('version', 'criteria', 'min_volume', 'min_volume_usd',
+                 'min_price_change', 'min_liquidity', 'min_market_cap',
+                 'max_market_cap', 'max_creator_ownership',
+                 'min_supply_traded', 'token_security', 'first_mint_time',
+                 'intervals', 'requires_security', 'token_checks',
+                 'enriched_checks')
+
+    def __init__(self, criteria, version, order=CHECK_NAMES):
+        criteria = copy.deepcopy(criteria)
+        self.version = version
         self.criteria = criteria
+        self.min_volume = tuple(criteria['min_volume'].items())
+        self.min_volume_usd = tuple(criteria['min_volume_usd'].items())
+        self.min_price_change = tuple(criteria['min_price_change'].items())
+        self.min_liquidity = criteria['min_liquidity']
+        self.min_market_cap = criteria['min_market_cap']
+        self.max_market_cap = criteria['max_market_cap']
+        self.max_creator_ownership = criteria['max_creator_ownership']
+        self.min_supply_traded = criteria['min_supply_traded']
+        self.token_security = bool(criteria['token_security'])
+        self.first_mint_time = epoch_micros(criteria['first_mint_date'])
 
-    def matches_criteria(self, token, ohlcv_data, security_data):
-        if not self._check_volume(token, ohlcv_data):
-            return False
-        if not self._check_volume_usd(ohlcv_data):
-            return False
-        if not self._check_liquidity(token):
-            return False
-        if not self._check_market_cap(token):
-            return False
-        if not self._check_price_change(ohlcv_data):
-            return False
-        if not self._check_creator_ownership(security_data):
-            return False
-        if not self._check_supply_traded(token, ohlcv_data):
-            return False
-        if not self._check_token_security(security_data):
-            return False
-        if not self._check_first_mint_date(token):
-            return False
-        return True
+        enabled = {
+            'volume': bool(self.min_volume),
+            'volume_usd': bool(self.min_volume_usd),
+            'price_change': bool(self.min_price_change),
+            # Ownership defaults to 100% when unknown, so a cap of 100% or
+            # more lets every token through
+            'creator_ownership': self.max_creator_ownership < 100,
+            'token_security': self.token_security,
+        }
+        checks = [(name, inputs, getattr(self, f'_check_{name}'))
+                  for name, inputs in CHECKS if enabled.get(name, True)]
+        checks.sort(key=lambda check: order.index(check[0]))
+        self.token_checks = tuple(check for check in checks
+                                  if check[1] == ('token', ))
+        self.enriched_checks = tuple(check for check in checks
+                                     if check[1] != ('token', ))
+
+        # The supply traded check always reads the 24h volume
+        intervals = {'24h'}
+        for thresholds in (self.min_volume, self.min_volume_usd,
+                           self.min_price_change):
+            for period, _ in thresholds:
+                interval_seconds(period)  # rejects unknown periods early
+                intervals.add(period)
+        self.intervals = frozenset(intervals)
+        self.requires_security = any(check[1] == ('security', )
+                                     for check in checks)
+
+    def reordered(self, order):
+        return FilterPlan(self.criteria, self.version, order)
 
     def _check_volume(self, token, ohlcv_data):
-        for period, min_volume in self.criteria['min_volume'].items():
-            if self._calculate_valid_volume(ohlcv_data[period]) < min_volume:
+        for period, min_volume in self.min_volume:
+            if ohlcv_data[period]['valid_volume'] < min_volume:
                 return False
         return True
 
     def _check_volume_usd(self, ohlcv_data):
-        for period, min_volume_usd in self.criteria['min_volume_usd'].items():
+        for period, min_volume_usd in self.min_volume_usd:
             if ohlcv_data[period]['volume_usd'] < min_volume_usd:
                 return False
         return True
 
     def _check_liquidity(self, token):
-        return token.get('liquidity', 0) >= self.criteria['min_liquidity']
+        return token.liquidity >= self.min_liquidity
 
     def _check_market_cap(self, token):
-        market_cap = token.get('marketCap', 0)
-        return self.criteria['min_market_cap'] <= market_cap <= self.criteria[
-            'max_market_cap']
+        return self.min_market_cap <= token.market_cap <= self.max_market_cap
 
     def _check_price_change(self, ohlcv_data):
-        for period, min_change in self.criteria['min_price_change'].items():
+        for period, min_change in self.min_price_change:
             if ohlcv_data[period]['price_change_percent'] < min_change:
                 return False
         return True
 
     def _check_creator_ownership(self, security_data):
-        return security_data.get('creator_ownership',
-                                 100) <= self.criteria['max_creator_ownership']
+        return security_data.creator_ownership <= self.max_creator_ownership
 
     def _check_supply_traded(self, token, ohlcv_data):
-        total_supply = token.get('totalSupply', 0)
+        total_supply = token.total_supply
         if total_supply == 0:
             return False
         volume_24h = ohlcv_data['24h']['volume']
         percent_traded = (volume_24h / total_supply) * 100
-        return percent_traded >= self.criteria['min_supply_traded']
+        return percent_traded >= self.min_supply_traded
 
     def _check_token_security(self, security_data):
-        return not self.criteria['token_security'] or security_data.get(
-            'is_secure', False)
+        return not self.token_security or security_data.is_secure
 
     def _check_first_mint_date(self, token):
-        first_mint_date = datetime.fromisoformat(
-            self.criteria['first_mint_date'])
-        token_mint_date = datetime.fromisoformat(
-            token.get('mintDate', '1970-01-01T00:00:00Z'))
-        return token_mint_date >= first_mint_date
-
-    def _calculate_valid_volume(self, ohlcv_data):
-        valid_volume = 0
-        for i, candle in enumerate(ohlcv_data):
-            if i == 0 or candle['price_change_percent'] == 0:
+        return token.mint_time >= self.first_mint_time
+
+
+class TokenFilter:
+
+    def __init__(self, criteria, reorder_every=1000, sample_every=64):
+        self.reorder_every = reorder_every
+        self.sample_every = sample_every
+        self.evaluations = 0
+        # Per check: [evaluated, rejected, sampled evaluations, sampled time]
+        self.stats = {name: [0, 0, 0, 0.0] for name in CHECK_NAMES}
+        self.unknown = {name: 0 for name in CHECK_NAMES}
+        # Per check: [evaluated, rejected] taken out of stats by halving, so
+        # check_counts() can report running totals
+        self.retired = {name: [0, 0] for name in CHECK_NAMES}
+        self.plan = FilterPlan(criteria, 1)
+
+    @property
+    def criteria(self):
+        return self.plan.criteria
+
+    def publish(self, criteria):
+        # Swapping the reference is atomic for the scan loop: evaluations
+        # already running keep the plan they started with
+        self.plan = FilterPlan(criteria, self.plan.version + 1,
+                               self._ranking())
+        return self.plan
+
+    def matches_criteria(self, token, ohlcv_data, security_data, plan=None):
+        plan = plan or self.plan
+        data = {'token': token, 'ohlcv': ohlcv_data, 'security': security_data}
+        return (self._matches(plan.token_checks, data)
+                and self._matches(plan.enriched_checks, data))
+
+    def matches_token_checks(self, token, plan=None):
+        plan = plan or self.plan
+        return self._matches(plan.token_checks, {'token': token})
+
+    def matches_enriched_checks(self,
+                                token,
+                                ohlcv_data,
+                                security_data,
+                                plan=None):
+        plan = plan or self.plan
+        return self._matches(plan.enriched_checks, {
+            'token': token,
+            'ohlcv': ohlcv_data,
+            'security': security_data
+        })
+
+    def required_intervals(self, plan=None):
+        return (plan or self.plan).intervals
+
+    def requires_security(self, plan=None):
+        return (plan or self.plan).requires_security
+
+    def _matches(self, checks, data):
+        self.evaluations += 1
+        if self.evaluations % self.reorder_every == 0:
+            self._reorder()
+        if None in data.values():
+            return self._matches_known(checks, data)
+        if self.evaluations % self.sample_every == 0:
+            return self._matches_timed(checks, data)
+        stats = self.stats
+        for name, inputs, check in checks:
+            counters = stats[name]
+            counters[0] += 1
+            if not check(*(data[key] for key in inputs)):
+                counters[1] += 1
+                return False
+        return True
+
+    def count_checks(self, checks, passing, bit, seconds=None):
+        # Counts an evaluation made for several profiles at once (see
+        # filter_profiles.ProfileIndex) as if checks had run in order:
+        # passing maps each check to the mask of the profiles it let
+        # through, or None if its data was unavailable, and bit is this
+        # profile's. seconds has the check times of sampled evaluations.
+        self.evaluations += 1
+        if self.evaluations % self.reorder_every == 0:
+            self._reorder()
+        for name, _, _ in checks:
+            passed = passing[name]
+            if passed is None:
+                self.unknown[name] += 1
                 continue
-            valid_volume += candle['volume']
-        return valid_volume
+            counters = self.stats[name]
+            counters[0] += 1
+            if seconds is not None:
+                counters[2] += 1
+                counters[3] += seconds[name]
+            if not passed & bit:
+                counters[1] += 1
+                return
+
+    def _matches_known(self, checks, data):
+        # OHLCV or security data is None when its endpoint is unavailable.
+        # Checks reading it are unknown and skipped, so a True result only
+        # means no check that could run rejected the token.
+        for name, inputs, check in checks:
+            if any(data[key] is None for key in inputs):
+                self.unknown[name] += 1
+                continue
+            counters = self.stats[name]
+            counters[0] += 1
+            if not check(*(data[key] for key in inputs)):
+                counters[1] += 1
+                return False
+        return True
+
+    def _matches_timed(self, checks, data):
+        for name, inputs, check in checks:
+            counters = self.stats[name]
+            counters[0] += 1
+            start = time.perf_counter()
+            passed = check(*(data[key] for key in inputs))
+            counters[2] += 1
+            counters[3] += time.perf_counter() - start
+            if not passed:
+                counters[1] += 1
+                return False
+        return True
+
+    def _ranking(self):
+        # Cheapest check per rejected token first; checks that never reject
+        # go last in their stage
+        def expected_cost(name):
+            evaluated, rejected, sampled, elapsed = self.stats[name]
+            cost = elapsed / sampled if sampled else 1e-6
+            if not rejected:
+                return float('inf'), CHECK_NAMES.index(name)
+            return cost * evaluated / rejected, CHECK_NAMES.index(name)
+
+        return sorted(CHECK_NAMES, key=expected_cost)
+
+    def check_counts(self):
+        # Per check: (evaluated, rejected, mean seconds of the sampled runs)
+        counts = {}
+        for name, (evaluated, rejected, sampled,
+                   elapsed) in self.stats.items():
+            retired = self.retired[name]
+            counts[name] = (retired[0] + evaluated, retired[1] + rejected,
+                            elapsed / sampled if sampled else None)
+        return counts
+
+    def _reorder(self):
+        plan = self.plan
+        self.plan = plan.reordered(self._ranking())
+        # Halve the counters so the order follows changes in the token mix
+        for name, counters in self.stats.items():
+            retired = self.retired[name]
+            retired[0] += counters[0] - counters[0] // 2
+            retired[1] += counters[1] - counters[1] // 2
+            counters[0] //= 2
+            counters[1] //= 2
+            counters[2] //= 2
+            counters[3] /= 2
+
+    def matches_batch(self, batch, plan=None):
+        # Vectorized matches_criteria over a columnar batch (see to_batch).
+        # Returns the match mask and, per token, the index in CHECK_NAMES of
+        # the first check it fails in that canonical order, or -1 if it
+        # matches. NumPy is only needed, and imported, on this path.
+        import numpy as np
+        plan = plan or self.plan
+        size = len(batch['liquidity'])
+        ones = np.ones(size, dtype=bool)
+
+        volume = ones.copy()
+        for period, min_volume in plan.min_volume:
+            volume &= batch['valid_volume'][period] >= min_volume
+        volume_usd = ones.copy()
+        for period, min_volume_usd in plan.min_volume_usd:
+            volume_usd &= batch['volume_usd'][period] >= min_volume_usd
+        price_change = ones.copy()
+        for period, min_change in plan.min_price_change:
+            price_change &= batch['price_change_percent'][period] >= min_change
+
+        total_supply = batch['total_supply']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percent_traded = (batch['volume']['24h'] / total_supply) * 100
+        supply_traded = (total_supply != 0) & (percent_traded
+                                               >= plan.min_supply_traded)
+
+        liquidity = batch['liquidity'] >= plan.min_liquidity
+        market_cap = ((batch['market_cap'] >= plan.min_market_cap) &
+                      (batch['market_cap'] <= plan.max_market_cap))
+        creator_ownership = (batch['creator_ownership']
+                             <= plan.max_creator_ownership)
+        token_security = batch['is_secure'] if plan.token_security else ones
+        first_mint_date = batch['mint_time'] >= plan.first_mint_time
+        results = [
+            volume, volume_usd, liquidity, market_cap, price_change,
+            creator_ownership, supply_traded, token_security, first_mint_date
+        ]
+
+        mask = ones.copy()
+        first_failed = np.full(size, -1, dtype=np.int8)
+        for index, passed in enumerate(results):
+            first_failed[mask & ~passed] = index
+            mask &= passed
+        return mask, first_failed
+
+
+def to_batch(tokens, ohlcv_data, security_data):
+    # Builds the columnar input of matches_batch from token records, security
+    # reports and window dicts. This costs more than evaluating the same
+    # tokens with matches_criteria, so it only pays off for data that is
+    # already columnar or is evaluated against many plans.
+    import numpy as np
+    periods = set()
+    for windows in ohlcv_data:
+        periods.update(windows)
+
+    def window_column(field):
+        return {
+            period:
+            np.array([windows[period][field] for windows in ohlcv_data],
+                     dtype=np.float64)
+            for period in periods
+        }
+
+    return {
+        'liquidity': _column(tokens, 'liquidity'),
+        'market_cap': _column(tokens, 'market_cap'),
+        'total_supply': _column(tokens, 'total_supply'),
+        'mint_time': _column(tokens, 'mint_time', 'int64'),
+        'creator_ownership': _column(security_data, 'creator_ownership'),
+        'is_secure': _column(security_data, 'is_secure', bool),
+        'volume': window_column('volume'),
+        'valid_volume': window_column('valid_volume'),
+        'volume_usd': window_column('volume_usd'),
+        'price_change_percent': window_column('price_change_percent'),
+    }
+
+
+def _column(records, field, dtype='float64'):
+    import numpy as np
+    return np.array([getattr(record, field) for record in records],
+                    dtype=dtype)
@@ -1,78 +1,398 @@
-from token_filter import TokenFilter
+import asyncio
+import functools
+import time
+from contextlib import aclosing
+import ohlcv
+from candle_store import CandleStore
+from filter_profiles import FilterProfiles
+from metrics import DISABLED
+from records import SecurityReport
+from resilience import CircuitOpenError
+from seen_tokens import SeenTokens
+
+# Tokens per chain kept for another try while an endpoint is unavailable
+MAX_DEFERRED = 1000
+# All-tokens pages of one chain evaluated at the same time
+MAX_BATCHES_IN_FLIGHT = 2
 
 
 class TokenScanner:
 
-    def __init__(self, api, filter_criteria, scan_new_listings_only):
+    def __init__(self,
+                 api,
+                 filter_criteria,
+                 scan_new_listings_only,
+                 max_concurrent_requests=20,
+                 ohlcv_base_interval='1m',
+                 candle_store_max_tokens=5000,
+                 state_store=None,
+                 seen_token_settings=None,
+                 all_tokens_page_size=500,
+                 metrics=None,
+                 shard=None,
+                 candle_store_max_bytes=64 * 1024 * 1024):
         self.api = api
-        self.token_filter = TokenFilter(filter_criteria)
+        self.profiles = FilterProfiles(filter_criteria, state_store)
         self.scan_new_listings_only = scan_new_listings_only
+        self.page_size = all_tokens_page_size
+        self.ohlcv_base_interval = ohlcv_base_interval
+        self.ohlcv_base_seconds = ohlcv.interval_seconds(ohlcv_base_interval)
+        # Tokens are seen again every cycle in all-tokens mode, so keep their
+        # candles and only fetch what changed since the last scan. Tokens
+        # enriched within the TTL whose market fields did not change are
+        # skipped; their last outcome was already reported.
+        self.candle_store = None
+        self.seen_tokens = None
+        self.seen_index = None
+        if not scan_new_listings_only:
+            self.candle_store = CandleStore(self.ohlcv_base_seconds,
+                                            candle_store_max_tokens,
+                                            candle_store_max_bytes)
+            self.seen_tokens = SeenTokens(**(seen_token_settings or {}))
+        # New listings fetched by the last scan of each chain
+        self.listing_counts = {}
+        # End of the listing window fetched by the running scan of each
+        # chain; it becomes the chain's cursor once the scan succeeds
+        self.fetched_to = {}
+        # Per chain, new listings whose data was partly unavailable; they are
+        # evaluated again on the next scan instead of being dropped or alerted
+        # unverified
+        self.deferred = {}
+        # Caps the number of Birdeye requests in flight across all chains
+        self.request_slots = asyncio.Semaphore(max_concurrent_requests)
+        # The all_tokens pages this process scans when sharded (see
+        # sharding.Shard); all of them if None
+        self.shard = shard
+        # Current unix time; replays substitute the recorded time
+        self.clock = time.time
+        (metrics or DISABLED).collect(self._collect_metrics)
+
+    @property
+    def token_filter(self):
+        return self.profiles.filters[None]
+
+    def _collect_metrics(self):
+        # The filters count as they go, so scrapes only read their counters
+        evaluated, rejected, seconds, unknown = [], [], [], []
+        for key, token_filter in self.profiles.filters.items():
+            profile = 'default' if key is None else key
+            for check, (checked, failed,
+                        mean) in token_filter.check_counts().items():
+                labels = dict(profile=profile, check=check)
+                evaluated.append((labels, checked))
+                rejected.append((labels, failed))
+                unknown.append((labels, token_filter.unknown[check]))
+                if mean is not None:
+                    seconds.append((labels, mean))
+        yield ('counter', 'filter_checks_total',
+               'Filter check evaluations per profile and check', evaluated)
+        yield ('counter', 'filter_rejections_total',
+               'Tokens rejected per profile and check', rejected)
+        yield ('counter', 'filter_unknown_total',
+               'Checks skipped because their data was unavailable', unknown)
+        yield ('gauge', 'filter_check_seconds',
+               'Mean time of a check over recent sampled evaluations', seconds)
+        yield ('gauge', 'deferred_tokens',
+               'New listings waiting for another try per chain', [
+                   (dict(chain=chain), len(addresses))
+                   for chain, addresses in self.deferred.items()
+               ])
+        if self.seen_tokens is not None:
+            yield ('gauge', 'seen_tokens', 'Tokens in the seen-token index',
+                   [({}, len(self.seen_tokens))])
 
     async def scan_tokens(self, chains):
+        chain_results = await asyncio.gather(*(self.scan_chain(chain)
+                                               for chain in chains))
         matching_tokens = []
-        for chain in chains:
-            try:
-                if self.scan_new_listings_only:
-                    tokens_to_scan = await self.api.get_new_listings(chain)
+        for chain_matches in chain_results:
+            matching_tokens.extend(chain_matches)
+        return matching_tokens
+
+    async def stream_tokens(self, chains, max_pending=100):
+        # Yields (chain, address, token, profile keys) as soon as a token
+        # matches on any chain; see FilterProfiles.recipients for the chats.
+        # The queue is bounded, so a slow consumer pauses the evaluations that
+        # want to hand over a match instead of letting matches pile up.
+        queue = asyncio.Queue(max_pending)
+
+        async def produce():
+            await asyncio.gather(*(self._stream_chain(chain, queue)
+                                   for chain in chains))
+            await queue.put(None)
+
+        producer = asyncio.create_task(produce())
+        getter = None
+        try:
+            while True:
+                getter = asyncio.ensure_future(queue.get())
+                await asyncio.wait((getter, producer),
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    match = getter.result()
                 else:
-                    tokens_to_scan = await self.api.get_all_tokens(chain)
-
-                if isinstance(tokens_to_scan, list):
-                    for token in tokens_to_scan:
-                        if isinstance(token, dict) and 'address' in token:
-                            token_data = await self.api.get_token_data(
-                                chain, token['address'])
-                        elif isinstance(token, str):
-                            # Assuming the token is just an address string
-                            token_data = await self.api.get_token_data(
-                                chain, token)
-                        else:
-                            continue  # Skip invalid token data
-
-                        ohlcv_data = {
-                            '5m':
-                            await
-                            self.api.get_ohlcv(chain, token_data['address'],
-                                               '5m'),
-                            '10m':
-                            await self.api.get_ohlcv(chain,
-                                                     token_data['address'],
-                                                     '10m'),
-                            '1h':
-                            await self.api.get_ohlcv(chain,
-                                                     token_data['address'],
-                                                     '1h'),
-                            '24h':
-                            await self.api.get_ohlcv(chain,
-                                                     token_data['address'],
-                                                     '24h')
-                        }
-                        security_data = await self.api.get_token_security(
-                            chain, token_data['address'])
-
-                        if self.token_filter.matches_criteria(
-                                token_data, ohlcv_data, security_data):
-                            matching_tokens.append(token_data)
-                elif isinstance(tokens_to_scan, dict):
-                    # Handle case where API returns a dict instead of a list
-                    for address, token_data in tokens_to_scan.items():
-                        ohlcv_data = {
-                            '5m': await
-                            self.api.get_ohlcv(chain, address, '5m'),
-                            '10m': await
-                            self.api.get_ohlcv(chain, address, '10m'),
-                            '1h': await
-                            self.api.get_ohlcv(chain, address, '1h'),
-                            '24h': await
-                            self.api.get_ohlcv(chain, address, '24h')
-                        }
-                        security_data = await self.api.get_token_security(
-                            chain, address)
-
-                        if self.token_filter.matches_criteria(
-                                token_data, ohlcv_data, security_data):
-                            matching_tokens.append(token_data)
-            except Exception as e:
-                print(f"Error scanning chain {chain}: {str(e)}")
+                    # The producer ended: re-raise its error, or take what
+                    # it queued before its final None
+                    getter.cancel()
+                    producer.result()
+                    match = queue.get_nowait()
+                if match is None:
+                    break
+                yield match
+        finally:
+            if getter is not None:
+                getter.cancel()
+            producer.cancel()
+
+    async def scan_chain(self, chain):
+        matching_tokens = []
+        try:
+            async with aclosing(self._chain_batches(chain)) as batches:
+                async for evaluations in batches:
+                    results = await asyncio.gather(*evaluations,
+                                                   return_exceptions=True)
+                    # Tokens whose data could not be fetched are already
+                    # skipped; anything raised here fails the chain, keeping
+                    # the matches found before it
+                    for result in results:
+                        if isinstance(result, Exception):
+                            raise result
+                        if result is not None:
+                            matching_tokens.append(result[1])
+            self._scanned(chain)
+        except Exception as e:
+            print(f"Error scanning chain {chain}: {str(e)}")
 
         return matching_tokens
+
+    async def _stream_chain(self, chain, queue):
+
+        async def emit(evaluation):
+            result = await evaluation
+            if result is not None:
+                await queue.put((chain, *result))
+
+        running = []  # tasks of the batches still being evaluated
+        try:
+            async with aclosing(self._chain_batches(chain)) as batches:
+                async for evaluations in batches:
+                    running.append(
+                        [asyncio.create_task(emit(e)) for e in evaluations])
+                    # Later pages wait for the oldest ones, so memory stays
+                    # bounded whatever the size of the chain
+                    while len(running) > MAX_BATCHES_IN_FLIGHT:
+                        await asyncio.gather(*running[0])
+                        running.pop(0)
+            while running:
+                await asyncio.gather(*running[0])
+                running.pop(0)
+            self._scanned(chain)
+        except Exception as e:
+            print(f"Error scanning chain {chain}: {str(e)}")
+        finally:
+            for tasks in running:
+                for task in tasks:
+                    task.cancel()
+
+    def _scanned(self, chain):
+        # Every listing fetched for the chain has been evaluated
+        fetched_to = self.fetched_to.pop(chain, None)
+        if fetched_to is not None:
+            self.api.advance_cursor(chain, fetched_to)
+
+    async def _chain_batches(self, chain):
+        # Yields lists of token evaluations: the new listings in one batch,
+        # or the chain's tokens a page at a time
+        if not self.scan_new_listings_only:
+            owns_page = None
+            if self.shard is not None:
+                owns_page = functools.partial(self.shard.owns_page, chain)
+            async with aclosing(
+                    self.api.iter_all_tokens(chain, self.page_size,
+                                             owns_page)) as pages:
+                async for page in pages:
+                    yield self._evaluations(chain, page)
+            return
+
+        tokens_to_scan, self.fetched_to[chain] = await self._request(
+            self.api.fetch_new_listings, chain)
+        self.listing_counts[chain] = len(tokens_to_scan or ())
+        deferred = self.deferred.pop(chain, None)
+        if deferred and isinstance(tokens_to_scan, list):
+            listed = {
+                token['address'] if isinstance(token, dict) else token
+                for token in tokens_to_scan
+            }
+            tokens_to_scan = tokens_to_scan + [
+                address for address in deferred if address not in listed
+            ]
+        yield self._evaluations(chain, tokens_to_scan)
+
+    def _evaluations(self, chain, tokens_to_scan):
+        if isinstance(tokens_to_scan, list):
+            return [
+                self._evaluate_listing(chain, token)
+                for token in tokens_to_scan
+            ]
+        if isinstance(tokens_to_scan, dict):
+            # Handle case where API returns a dict instead of a list
+            return [
+                self._evaluate_token(chain, address, token_data)
+                for address, token_data in tokens_to_scan.items()
+            ]
+        return []
+
+    async def _request(self, call, *args):
+        async with self.request_slots:
+            return await call(*args)
+
+    async def evaluate_listing(self, chain, address):
+        # A listing pushed outside of a scan; returns (address, token,
+        # profile_keys) if it matches
+        return await self._evaluate_listing(chain, address)
+
+    async def _evaluate_listing(self, chain, token):
+        if isinstance(token, dict) and 'address' in token:
+            address = token['address']
+        elif isinstance(token, str):
+            # Assuming the token is just an address string
+            address = token
+        else:
+            return None  # Skip invalid token data
+
+        try:
+            token_data = await self._request(self.api.get_token_data, chain,
+                                             address)
+        except CircuitOpenError:
+            self._defer(chain, address)
+            return None
+        except Exception as e:
+            self._failed(chain, address, e)
+            return None
+        return await self._evaluate_token(chain, address, token_data)
+
+    async def _evaluate_token(self, chain, address, token_data):
+        # Returns the address, the token and the keys of the profiles it
+        # matches. A token whose data cannot be fetched is skipped, so it
+        # does not fail the rest of the chain's scan.
+        try:
+            return await self._match_token(chain, address, token_data)
+        except Exception as e:
+            self._failed(chain, address, e)
+            return None
+
+    def _failed(self, chain, address, error):
+        # Not deferred: a request Birdeye keeps rejecting (such as a 404 for
+        # a token it has not indexed yet) would fail again on every scan
+        print(f"Error evaluating {chain} token {address}: {str(error)}")
+
+    async def _match_token(self, chain, address, token_data):
+        # Every profile is matched against the same fetched data
+        index = self.profiles.index
+        fingerprint = None
+        if self.seen_tokens is not None:
+            if index is not self.seen_index:
+                # Changed criteria can change the outcome for any token
+                self.seen_tokens.clear()
+                self.seen_index = index
+            fingerprint = self.seen_tokens.fingerprint(token_data)
+            if self.seen_tokens.unchanged(chain, address, fingerprint):
+                return None
+
+        if index.single is not None:
+            return await self._evaluate_single(chain, address, token_data,
+                                               index, fingerprint)
+
+        # Cheap checks on token data first; OHLCV and security are only
+        # fetched for the profiles the token is still alive for
+        mask = index.token_mask(token_data)
+        if not mask:
+            return None
+
+        ohlcv_data, security_data = await asyncio.gather(
+            self._fetch_ohlcv(chain, address, index.intervals(mask)),
+            self._fetch_security(chain, address,
+                                 index.requires_security(mask)))
+        complete = ohlcv_data is not None and security_data is not None
+        if complete:
+            self._remember(chain, address, fingerprint)
+
+        mask = index.enriched_mask(token_data, ohlcv_data, security_data, mask)
+        if mask and not complete:
+            self._defer(chain, address)
+        elif mask:
+            return address, token_data, index.profiles(mask)
+        return None
+
+    async def _evaluate_single(self, chain, address, token_data, index,
+                               fingerprint):
+        token_filter = index.single
+        # One plan version is used for the whole token, even if the criteria
+        # are republished while its data is being fetched
+        plan = token_filter.plan
+        if not token_filter.matches_token_checks(token_data, plan):
+            return None
+
+        ohlcv_data, security_data = await asyncio.gather(
+            self._fetch_ohlcv(chain, address, plan.intervals),
+            self._fetch_security(chain, address, plan.requires_security))
+        complete = ohlcv_data is not None and security_data is not None
+        if complete:
+            self._remember(chain, address, fingerprint)
+
+        if not token_filter.matches_enriched_checks(token_data, ohlcv_data,
+                                                    security_data, plan):
+            return None
+        if not complete:
+            self._defer(chain, address)
+            return None
+        return address, token_data, index.keys
+
+    def _remember(self, chain, address, fingerprint):
+        # Tokens rejected on token data alone are cheap to check again, so
+        # only enriched tokens take space in the index
+        if fingerprint is not None:
+            self.seen_tokens.remember(chain, address, fingerprint)
+
+    def _defer(self, chain, address):
+        # A token that passes every check its data was available for is
+        # unknown, not a match. All-tokens scans see it again anyway.
+        if not self.scan_new_listings_only:
+            return
+        deferred = self.deferred.setdefault(chain, {})
+        deferred[address] = None
+        if len(deferred) > MAX_DEFERRED:
+            del deferred[next(iter(deferred))]
+
+    async def _fetch_ohlcv(self, chain, address, intervals):
+        # None while the endpoint's circuit is open
+        try:
+            return await self._fetch_ohlcv_windows(chain, address, intervals)
+        except CircuitOpenError:
+            return None
+
+    async def _fetch_ohlcv_windows(self, chain, address, intervals):
+        # One base-resolution series covers every window the criteria use
+        end = ohlcv.window_end(self.clock(), self.ohlcv_base_seconds)
+        span = max(ohlcv.interval_seconds(interval) for interval in intervals)
+        if self.candle_store is None:
+            candles = await self._request(self.api.get_ohlcv, chain, address,
+                                          self.ohlcv_base_interval, end - span,
+                                          end)
+            return ohlcv.build_windows(candles, intervals, end)
+
+        series = self.candle_store.get(chain, address, intervals)
+        time_from = series.fetch_from(end, span)
+        candles = await self._request(self.api.get_ohlcv, chain, address,
+                                      self.ohlcv_base_interval, time_from, end)
+        series.update(candles, time_from, end)
+        return series.summaries(intervals)
+
+    async def _fetch_security(self, chain, address, required):
+        if not required:
+            return SecurityReport()
+        try:
+            return await self._request(self.api.get_token_security, chain,
+                                       address)
+        except CircuitOpenError:
+            return None